@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+import tomllib
+import uuid
+from contextlib import asynccontextmanager
+from io import BytesIO
+
+from azure.core.credentials import AzureKeyCredential
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from fastapi import Depends, FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import FileResponse, Response
+from fastapi.security import APIKeyHeader
+from starlette.background import BackgroundTask
+
+from batch_analytics import new_cache, refresh_cache
+from excel_export import write_batch_workbook
+from incremental import finish_reanalysis, page_hashes, page_range, plan_reanalysis
+from invoice_index import iter_extractions, load_extraction, save_extraction, search_invoices
+from invoice_processing import data_to_dataframe, extract_table_data, unconfident_fields
+from preflight import PreflightError, preflight_file
+
+
+# Load configuration, the same secrets the Streamlit app reads
+secrets_path = os.environ.get('INVOICE_SECRETS_PATH', '.streamlit/secrets.toml')
+with open(secrets_path, 'rb') as secrets_file:
+    secrets = tomllib.load(secrets_file)
+
+azure_document_api_key = secrets['azure_document_api_key']
+azure_document_endpoint = secrets['azure_document_endpoint']
+custom_model_id = secrets['custom_model_id']
+# Every request must send this in the X-API-Key header, the API serves every stored invoice
+api_key = secrets['api_key']
+required_fields = secrets.get('required_fields', ['VendorName', 'InvoiceId', 'InvoiceDate', 'InvoiceTotal'])
+custom_model_confidence_threshold = float(secrets.get('custom_model_confidence_threshold', 0.8))
+# How many documents one process keeps in flight against the service at once
+max_concurrent_jobs = int(secrets.get('max_concurrent_jobs', 16))
+# Finished jobs are forgotten after this long, their results stay in the index under invoice_pk
+job_ttl_seconds = int(secrets.get('job_ttl_seconds', 3600))
+
+clients = {}
+jobs = {}
+analytics_cache = new_cache()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    credential = AzureKeyCredential(azure_document_api_key)
+    clients['analysis'] = DocumentAnalysisClient(endpoint=azure_document_endpoint, credential=credential)
+    clients['intelligence'] = DocumentIntelligenceClient(endpoint=azure_document_endpoint, credential=credential)
+    clients['slots'] = asyncio.Semaphore(max_concurrent_jobs)
+    yield
+    await clients['analysis'].close()
+    await clients['intelligence'].close()
+
+
+def require_api_key(key: str = Depends(APIKeyHeader(name='X-API-Key', auto_error=False))):
+    if key is None or not hmac.compare_digest(key.encode(), api_key.encode()):
+        raise HTTPException(status_code=401, detail="Missing or invalid API key")
+
+
+app = FastAPI(title="Invoice Data Extraction", lifespan=lifespan, dependencies=[Depends(require_api_key)])
+
+
+async def analyze_invoice(file_bytes, pages=None):
+    poller = await clients['analysis'].begin_analyze_document("prebuilt-invoice", file_bytes, pages=pages)
+    return await poller.result()
+
+
+async def layout_invoice(file_bytes, content_type, pages=None):
+    poller = await clients['intelligence'].begin_analyze_document("prebuilt-layout", file_bytes,
+                                                                  content_type=content_type, pages=pages)
+    return await poller.result()
+
+
+async def analyze_custom_model(file_bytes, content_type, pages=None):
+    poller = await clients['intelligence'].begin_analyze_document(custom_model_id, file_bytes,
+                                                                  content_type=content_type, pages=pages)
+    return await poller.result()
+
+
+async def analyze_with_reuse(model_id, hashes, analyze):
+    previous_result, pages_to_analyze, changed = await asyncio.to_thread(plan_reanalysis, model_id, hashes)
+    if previous_result is None:
+        new_result = await analyze(None)
+    elif pages_to_analyze:
+        new_result = await analyze(page_range(pages_to_analyze))
+    else:
+        new_result = None
+    return await asyncio.to_thread(finish_reanalysis, model_id, hashes, previous_result, new_result, changed)
+
+
+async def run_job(job_id, file_bytes, content_type):
+    job = jobs[job_id]
+    try:
+        async with clients['slots']:
+            job['status'] = 'running'
+            hashes = await asyncio.to_thread(page_hashes, file_bytes, content_type)
+            # Layout does not depend on the prebuilt result, so both go out together
+            invoice_data, layout_data = await asyncio.gather(
+                analyze_with_reuse("prebuilt-invoice", hashes, lambda pages: analyze_invoice(file_bytes, pages)),
+                analyze_with_reuse("prebuilt-layout", hashes,
+                                   lambda pages: layout_invoice(file_bytes, content_type, pages)))
+
+            custom_data = None
+            if unconfident_fields(invoice_data, required_fields, custom_model_confidence_threshold):
+                custom_data = await analyze_with_reuse(
+                    custom_model_id, hashes, lambda pages: analyze_custom_model(file_bytes, content_type, pages))
+                job['custom_model_called'] = True
+
+        # Flattening hundreds of line items is CPU work, keep it off the event loop
+        fields_df, items_df = await asyncio.to_thread(
+            data_to_dataframe, invoice_data, custom_data, custom_model_confidence_threshold)
+        table_df = await asyncio.to_thread(extract_table_data, layout_data)
+        # Results are served from the index, the job itself only keeps the key
+        job['invoice_pk'] = await asyncio.to_thread(save_extraction, job['filename'], fields_df, items_df, table_df,
+                                                    file_hash=hashlib.sha256(file_bytes).hexdigest())
+        job['status'] = 'succeeded'
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        job['finished_at'] = time.monotonic()
+        job.pop('task', None)
+
+
+def evict_jobs():
+    # Running jobs have no finished_at yet and are never evicted
+    expired_before = time.monotonic() - job_ttl_seconds
+    expired = [job_id for job_id, job in jobs.items() if job.get('finished_at', expired_before) < expired_before]
+    for job_id in expired:
+        del jobs[job_id]
+
+
+def get_job(job_id):
+    evict_jobs()
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return jobs[job_id]
+
+
+def dataframe_response(df, format):
+    if format == 'json':
+        return Response(df.to_json(orient='records', date_format='iso'), media_type='application/json')
+    if format == 'parquet':
+        output = BytesIO()
+        df.to_parquet(output, index=False)
+        return Response(output.getvalue(), media_type='application/vnd.apache.parquet')
+    raise HTTPException(status_code=400, detail="format must be json or parquet")
+
+
+async def job_result(job_id, position, format):
+    job = get_job(job_id)
+    if job['status'] != 'succeeded':
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    # load_extraction returns (fields_df, items_df, table_df)
+    extraction = await asyncio.to_thread(load_extraction, job['invoice_pk'])
+    if extraction is None:
+        raise HTTPException(status_code=404, detail=f"Invoice {job['invoice_pk']} is no longer in the index")
+    return dataframe_response(extraction[position], format)
+
+
+@app.post('/invoices', status_code=202)
+async def submit_invoice(file: UploadFile = File(...)):
+    try:
+        # Decrypting and re-encoding large files is CPU work, keep it off the event loop
+        file_bytes, content_type = await asyncio.to_thread(preflight_file, await file.read(), file.filename)
+    except PreflightError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    evict_jobs()
+    job_id = uuid.uuid4().hex
+    jobs[job_id] = {'status': 'queued', 'filename': file.filename, 'error': None, 'custom_model_called': False}
+    # Keep a reference to the task so it is not garbage collected mid-analysis
+    jobs[job_id]['task'] = asyncio.create_task(run_job(job_id, file_bytes, content_type))
+    return {'job_id': job_id, 'status': 'queued'}
+
+
+@app.get('/invoices/{job_id}')
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    return {
+        'job_id': job_id,
+        'filename': job['filename'],
+        'status': job['status'],
+        'error': job['error'],
+        'custom_model_called': job['custom_model_called'],
+        'invoice_pk': job.get('invoice_pk'),
+    }
+
+
+@app.get('/invoices/{job_id}/fields')
+async def job_fields(job_id: str, format: str = 'json'):
+    return await job_result(job_id, 0, format)
+
+
+@app.get('/invoices/{job_id}/items')
+async def job_items(job_id: str, format: str = 'json'):
+    return await job_result(job_id, 1, format)
+
+
+@app.get('/invoices/{job_id}/tables')
+async def job_tables(job_id: str, format: str = 'json'):
+    return await job_result(job_id, 2, format)
+
+
+@app.get('/search')
+async def search(vendor: str = None, min_total: float = None, max_total: float = None,
+                 date_from: str = None, date_to: str = None, text: str = None, limit: int = 100):
+    results = await asyncio.to_thread(search_invoices, vendor=vendor, min_total=min_total, max_total=max_total,
+                                      date_from=date_from, date_to=date_to, text=text, limit=limit)
+    return dataframe_response(results, 'json')
+
+
+@app.get('/analytics/{view}')
+async def analytics(view: str):
+    aggregates = await asyncio.to_thread(refresh_cache, analytics_cache)
+    if view not in aggregates:
+        raise HTTPException(status_code=404, detail=f"view must be one of {', '.join(aggregates)}")
+    return dataframe_response(aggregates[view], 'json')
+
+
+@app.get('/export.xlsx')
+async def export_workbook(ids: str = None):
+    invoice_pks = [int(invoice_pk) for invoice_pk in ids.split(',')] if ids else None
+    path = await asyncio.to_thread(write_batch_workbook, iter_extractions(invoice_pks))
+    # The file is streamed from disk and removed once the response has been sent
+    return FileResponse(path, filename='invoice_batch.xlsx', background=BackgroundTask(os.remove, path),
+                        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+if __name__ == '__main__':
+    import uvicorn
+    # Local only unless HOST is set, e.g. HOST=0.0.0.0 behind a reverse proxy
+    uvicorn.run(app, host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get('PORT', 8000)))
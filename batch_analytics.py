@@ -0,0 +1,111 @@
+import threading
+from io import BytesIO
+
+import pandas as pd
+
+from invoice_index import INDEX_PATH, load_extractions_since
+
+
+GROUP_COLUMNS = ['vendor', 'period', 'currency']
+
+# Invoice fields whose typed Amount is summed across the batch
+AMOUNT_FIELDS = {'InvoiceTotal': 'total', 'SubTotal': 'subtotal', 'TotalTax': 'tax', 'AmountDue': 'amount_due'}
+
+SUMMARY_COLUMNS = ['invoice_pk', 'vendor', 'invoice_date', 'period', 'currency', *AMOUNT_FIELDS.values(),
+                   'quantity', 'line_items']
+
+VALUE_COLUMNS = [*AMOUNT_FIELDS.values(), 'quantity', 'line_items']
+
+
+def summarize_extractions(extractions):
+    # extractions is a list of (invoice_pk, fields_df, items_df); everything below works on the
+    # concatenated frames so the cost is a few groupbys rather than a Python loop per invoice
+    if not extractions:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS).set_index('invoice_pk')
+
+    fields = [fields_df.assign(invoice_pk=invoice_pk) for invoice_pk, fields_df, _ in extractions if not fields_df.empty]
+    summaries = pd.DataFrame(index=pd.Index([invoice_pk for invoice_pk, _, _ in extractions], name='invoice_pk'))
+
+    if fields:
+        fields = pd.concat(fields, ignore_index=True).drop_duplicates(['invoice_pk', 'Key'])
+        by_key = fields.set_index(['invoice_pk', 'Key'])
+        vendor = by_key['Value'].xs('VendorName', level='Key') if 'VendorName' in fields['Key'].values else None
+        if vendor is not None:
+            summaries['vendor'] = vendor.where(vendor != 'N/A').str.strip()
+        if 'Date' in by_key.columns and 'InvoiceDate' in fields['Key'].values:
+            summaries['invoice_date'] = pd.to_datetime(by_key['Date'].xs('InvoiceDate', level='Key'), errors='coerce')
+        if 'Amount' in by_key.columns:
+            amounts = by_key['Amount'].unstack('Key')
+            for key, column in AMOUNT_FIELDS.items():
+                if key in amounts.columns:
+                    summaries[column] = pd.to_numeric(amounts[key], errors='coerce')
+        if 'Currency' in by_key.columns and 'InvoiceTotal' in fields['Key'].values:
+            summaries['currency'] = by_key['Currency'].xs('InvoiceTotal', level='Key')
+
+    items = [items_df.assign(invoice_pk=invoice_pk) for invoice_pk, _, items_df in extractions if not items_df.empty]
+    if items:
+        items = pd.concat(items, ignore_index=True)
+        grouped = items.groupby('invoice_pk')
+        summaries['line_items'] = grouped.size()
+        if 'Quantity' in items.columns:
+            summaries['quantity'] = pd.to_numeric(items['Quantity'], errors='coerce').groupby(items['invoice_pk']).sum()
+
+    summaries = summaries.reindex(columns=SUMMARY_COLUMNS[1:])
+    summaries['invoice_date'] = pd.to_datetime(summaries['invoice_date'], errors='coerce')
+    summaries['period'] = summaries['invoice_date'].dt.to_period('M').astype(str).where(summaries['invoice_date'].notna())
+    summaries['vendor'] = summaries['vendor'].fillna('Unknown vendor')
+    summaries['period'] = summaries['period'].fillna('Undated')
+    summaries['currency'] = summaries['currency'].fillna('Unknown')
+    summaries[VALUE_COLUMNS] = summaries[VALUE_COLUMNS].apply(pd.to_numeric, errors='coerce').fillna(0)
+    return summaries
+
+
+def aggregate_summaries(summaries):
+    aggregations = {'invoices': ('vendor', 'size'), **{column: (column, 'sum') for column in VALUE_COLUMNS}}
+    by_vendor_period = summaries.groupby(GROUP_COLUMNS, as_index=False).agg(**aggregations)
+    # The coarser views roll up the fine-grained one instead of going back to the invoices
+    rollup = {column: 'sum' for column in ['invoices', *VALUE_COLUMNS]}
+    by_vendor = by_vendor_period.groupby(['vendor', 'currency'], as_index=False).agg(rollup)
+    by_period = by_vendor_period.groupby(['period', 'currency'], as_index=False).agg(rollup)
+    return {
+        'by_vendor_period': by_vendor_period.sort_values(GROUP_COLUMNS, ignore_index=True),
+        'by_vendor': by_vendor.sort_values('total', ascending=False, ignore_index=True),
+        'by_period': by_period.sort_values('period', ignore_index=True),
+    }
+
+
+def new_cache():
+    return {
+        'lock': threading.Lock(),
+        'summaries': summarize_extractions([]),
+        'watermark': None,
+        'aggregates': aggregate_summaries(summarize_extractions([])),
+    }
+
+
+def refresh_cache(cache, db_path=INDEX_PATH):
+    with cache['lock']:
+        rows = load_extractions_since(cache['watermark'], db_path=db_path)
+        if rows.empty:
+            return cache['aggregates']
+
+        extractions = [(invoice_pk, fields_df, items_df)
+                       for invoice_pk, fields_df, items_df in zip(rows['id'], rows['fields_df'], rows['items_df'])]
+        new_summaries = summarize_extractions(extractions)
+        # Re-saved (edited) invoices come back with a newer version and replace their old summary
+        summaries = cache['summaries']
+        summaries = pd.concat([summaries[~summaries.index.isin(new_summaries.index)], new_summaries])
+        cache['summaries'] = summaries
+        cache['watermark'] = int(rows['version'].max())
+        cache['aggregates'] = aggregate_summaries(summaries)
+        return cache['aggregates']
+
+
+def create_summary_excel(aggregates):
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        aggregates['by_vendor'].to_excel(writer, sheet_name='By_Vendor', index=False)
+        aggregates['by_period'].to_excel(writer, sheet_name='By_Period', index=False)
+        aggregates['by_vendor_period'].to_excel(writer, sheet_name='By_Vendor_Period', index=False)
+    output.seek(0)
+    return output
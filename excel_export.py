@@ -0,0 +1,173 @@
+import os
+import re
+import tempfile
+from io import BytesIO
+
+import pandas as pd
+from openpyxl import Workbook
+
+from invoice_index import field_lookup, key_columns
+
+
+def create_excel(fields_df, table_df, items_df=None):
+    if items_df is None:
+        items_df = pd.DataFrame()
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+          current_row = 0
+        
+          if not fields_df.empty:
+                worksheet = writer.book.create_sheet('Invoice_Data')
+                worksheet.cell(row=current_row + 1, column=1).value = "=== INVOICE FIELDS ==="
+                current_row += 2
+                
+                fields_df.to_excel(writer, sheet_name='Invoice_Data', startrow=current_row, index=False)
+                current_row += len(fields_df) + 3  # Add some space
+
+          if not items_df.empty:
+                if fields_df.empty:
+                    worksheet = writer.book.create_sheet('Invoice_Data')
+                    current_row = 0
+
+                worksheet.cell(row=current_row + 1, column=1).value = "=== LINE ITEMS ==="
+                current_row += 2
+
+                items_df.to_excel(writer, sheet_name='Invoice_Data', startrow=current_row, index=False)
+                current_row += len(items_df) + 3
+        
+          if not table_df.empty:
+                if fields_df.empty and items_df.empty:
+                    worksheet = writer.book.create_sheet('Invoice_Data')
+                    current_row = 0
+                
+                worksheet.cell(row=current_row + 1, column=1).value = "=== INVOICE TABLES ==="
+                current_row += 2
+                
+                table_df.to_excel(writer, sheet_name='Invoice_Data', startrow=current_row, index=False)
+            
+          if fields_df.empty and items_df.empty and table_df.empty:
+                empty_df = pd.DataFrame({'Message': ['No data extracted from the invoice']})
+                empty_df.to_excel(writer, sheet_name='Invoice_Data', index=False)
+            
+          if 'Invoice_Data' in writer.sheets:
+                worksheet = writer.sheets['Invoice_Data']
+                for column in worksheet.columns:
+                    max_length = 0
+                    column_letter = column[0].column_letter
+                    for cell in column:
+                        try:
+                            if len(str(cell.value)) > max_length:
+                                max_length = len(str(cell.value))
+                        except:
+                            pass
+                    adjusted_width = min(max_length + 2, 50)
+                    worksheet.column_dimensions[column_letter].width = adjusted_width
+        
+          output.seek(0)
+          return output
+
+
+INVALID_SHEET_CHARACTERS = re.compile(r'[\[\]:*?/\\]')
+
+INDEX_COLUMNS = ['Sheet', 'File', 'Vendor', 'Invoice Id', 'Invoice Date', 'Currency', 'Total', 'Tax', 'Line Items']
+
+
+def sheet_title(name, used_titles):
+    # Excel sheet names are at most 31 characters, unique and free of []:*?/\
+    base = INVALID_SHEET_CHARACTERS.sub('_', name).strip("'") or 'Invoice'
+    title = base[:31]
+    counter = 2
+    while title.lower() in used_titles:
+        suffix = f" ({counter})"
+        title = base[:31 - len(suffix)] + suffix
+        counter += 1
+    used_titles.add(title.lower())
+    return title
+
+
+def cell_value(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value
+
+
+def append_dataframe(worksheet, df, heading):
+    worksheet.append([heading])
+    worksheet.append([])
+    worksheet.append(list(df.columns))
+    for row in df.itertuples(index=False):
+        worksheet.append([cell_value(value) for value in row])
+    worksheet.append([])
+    worksheet.append([])
+
+
+def open_batch_workbook(path=None):
+    # Write-only worksheets stream their rows to temp files, so memory does not grow with the batch
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.xlsx', prefix='invoice_batch_')
+        os.close(handle)
+    workbook = Workbook(write_only=True)
+    index_sheet = workbook.create_sheet('Index')
+    for column_letter, width in zip('ABCDEFGHI', [32, 32, 32, 16, 14, 10, 14, 12, 10]):
+        index_sheet.column_dimensions[column_letter].width = width
+    index_sheet.append(INDEX_COLUMNS)
+    return {'workbook': workbook, 'index_sheet': index_sheet, 'path': path, 'titles': {'index'}, 'count': 0}
+
+
+def append_invoice(batch, name, fields_df, table_df, items_df=None):
+    if items_df is None:
+        items_df = pd.DataFrame()
+    title = sheet_title(os.path.splitext(name)[0], batch['titles'])
+    worksheet = batch['workbook'].create_sheet(title)
+    worksheet.column_dimensions['A'].width = 32
+    worksheet.column_dimensions['B'].width = 50
+
+    worksheet.append([f'=HYPERLINK("#\'Index\'!A1","Back to index")'])
+    worksheet.append([])
+    if not fields_df.empty:
+        append_dataframe(worksheet, fields_df, "=== INVOICE FIELDS ===")
+    if not items_df.empty:
+        append_dataframe(worksheet, items_df, "=== LINE ITEMS ===")
+    if not table_df.empty:
+        append_dataframe(worksheet, table_df, "=== INVOICE TABLES ===")
+    if fields_df.empty and items_df.empty and table_df.empty:
+        worksheet.append(['No data extracted from the invoice'])
+    # Each open write-only sheet holds a temp file handle until save, large batches ran out of descriptors
+    worksheet.close()
+
+    columns = key_columns(fields_df)
+    sheet_link = title.replace("'", "''")
+    batch['index_sheet'].append([
+        f'=HYPERLINK("#\'{sheet_link}\'!A1","{title.replace(chr(34), chr(34) * 2)}")',
+        name,
+        columns['vendor_name'],
+        columns['invoice_id'],
+        columns['invoice_date'],
+        columns['currency'],
+        columns['invoice_total'],
+        cell_value(field_lookup(fields_df, 'TotalTax', 'Amount')),
+        len(items_df),
+    ])
+    batch['count'] += 1
+    return title
+
+
+def close_batch_workbook(batch):
+    if batch['count'] == 0:
+        batch['index_sheet'].append(['No invoices in this batch'])
+    batch['workbook'].save(batch['path'])
+    return batch['path']
+
+
+def write_batch_workbook(extractions, path=None):
+    # extractions yields (name, fields_df, table_df, items_df) one invoice at a time
+    batch = open_batch_workbook(path)
+    try:
+        for name, fields_df, table_df, items_df in extractions:
+            append_invoice(batch, name, fields_df, table_df, items_df)
+        return close_batch_workbook(batch)
+    except Exception:
+        # Do not leave the half-written temp file behind, a caller-supplied path is the caller's to clean up
+        if path is None and os.path.exists(batch['path']):
+            os.remove(batch['path'])
+        raise
@@ -1,5 +1,6 @@
 import streamlit as st
 from PIL import Image
+import hashlib
 import json
 import pandas as pd
 import io
@@ -13,6 +14,11 @@ from azure.cognitiveservices.vision.computervision import ComputerVisionClient
 from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes
 from msrest.authentication import CognitiveServicesCredentials
 from openai import AzureOpenAI
+from preflight import PreflightError, preflight_file
+from invoice_processing import data_to_dataframe, extract_table_data, retype_edited_fields, unconfident_fields
+from invoice_index import save_extraction
+from excel_export import create_excel
+from incremental import analyze_with_reuse, page_hashes
 
 
 
@@ -38,6 +44,9 @@ st.set_page_config(layout="wide")
 azure_document_api_key = st.secrets["azure_document_api_key"]
 azure_document_endpoint = st.secrets["azure_document_endpoint"]
 custom_model_id = st.secrets["custom_model_id"]
+# The custom model only runs when prebuilt-invoice misses one of these or is less confident than the threshold
+required_fields = st.secrets.get("required_fields", ['VendorName', 'InvoiceId', 'InvoiceDate', 'InvoiceTotal'])
+custom_model_confidence_threshold = float(st.secrets.get("custom_model_confidence_threshold", 0.8))
 
 
 model_id = 'prebuilt-invoice'
@@ -52,10 +61,10 @@ document_intelligence_client = DocumentIntelligenceClient(
     credential=AzureKeyCredential(azure_document_api_key))
 
 
-def analyze_invoice(uploaded_file):
+def analyze_invoice(file_bytes, pages=None):
     try:
-        file_stream = BytesIO(uploaded_file.getvalue())
-        poller = document_analysis_client.begin_analyze_document("prebuilt-invoice", file_stream)
+        file_stream = BytesIO(file_bytes)
+        poller = document_analysis_client.begin_analyze_document("prebuilt-invoice", file_stream, pages=pages)
         result = poller.result()
         # print(result)
         return result
@@ -63,24 +72,15 @@ def analyze_invoice(uploaded_file):
         st.error(f"Error processing invoice: {str(e)}")
         return None
     
-def layout_invoice(uploaded_file):
+def layout_invoice(file_bytes, content_type, pages=None):
     try:
         # st.write("Attempting prebuilt-layout analysis...")
-        file_stream = BytesIO(uploaded_file.getvalue())
-        if uploaded_file.name.lower().endswith('.pdf'):
-            content_type = "application/pdf"
-        elif uploaded_file.name.lower().endswith(('.jpg','.jpeg')):
-            content_type = "image/jpeg"
-        elif uploaded_file.name.lower().endswith(('.png')):
-            content_type = "image/png"
-        else:
-            st.error("Unsupported file type. Please upload a PNG, JPG, JPEG, or PNG file.")
-            return None
-
+        file_stream = BytesIO(file_bytes)
         poller = document_intelligence_client.begin_analyze_document(
             "prebuilt-layout", 
             file_stream, 
-            content_type=content_type)
+            content_type=content_type,
+            pages=pages)
         
         result = poller.result()
         # print(result)
@@ -89,24 +89,15 @@ def layout_invoice(uploaded_file):
     except Exception as e:
         st.error(f"Error processing invoice layout: {str(e)}")
         return None
-def analyze_custom_model(uploaded_file):
+def analyze_custom_model(file_bytes, content_type, pages=None):
     try:
         # st.write(f"🔍 Attempting custom model analysis")
-        file_stream = BytesIO(uploaded_file.getvalue())
-        if uploaded_file.name.lower().endswith('.pdf'):
-            content_type = "application/pdf"
-        elif uploaded_file.name.lower().endswith(('.jpg', '.jpeg')):
-            content_type = "image/jpeg"
-        elif uploaded_file.name.lower().endswith('.png'):
-            content_type = "image/png"
-        else:
-            st.error("Unsupported file type. Please upload a PNG, JPG, JPEG, or PDF file.")
-            return None
-        
+        file_stream = BytesIO(file_bytes)
         poller = document_intelligence_client.begin_analyze_document(
             custom_model_id, 
             file_stream, 
-            content_type=content_type
+            content_type=content_type,
+            pages=pages
         )
         result = poller.result()
         # print("this is the custom model")
@@ -119,124 +110,18 @@ def analyze_custom_model(uploaded_file):
         return None
 
 
-def flatten_data(field, prefix=''):
-    flat_data = {}
-    if hasattr(field, 'value') and isinstance(field.value, dict):
-        for sub_key, sub_field in field.value.items():
-            flat_data.update(flatten_data(sub_field, prefix=f"{prefix}{sub_key}_"))
-        print("flat_data_dict", flat_data)
-    else:
-        content = getattr(field, 'content', 'N/A') if hasattr(field, 'content') else 'N/A'
-        flat_data[prefix.rstrip('_')] = content
-    return flat_data
+@st.cache_resource
+def custom_model_stats():
+    # Shared across sessions so the skip rate covers every invoice this server has processed
+    return {'called': 0, 'skipped': 0}
 
-        
-def extract_table_data(document):
-    tables_list = []
-
-    if hasattr(document, 'tables'):
-        for table in document.tables:
-            table_data = []
-            for cell in table.cells:
-                if len(table_data) <= cell.row_index:
-                    table_data.extend([{} for _ in range(cell.row_index + 1 - len(table_data))])
-                column_header = f"Column {cell.column_index}" 
-                table_data[cell.row_index][column_header] = cell.content
-            if table_data:
-                df = pd.DataFrame(table_data)
-                tables_list.append(df)
-
-    if tables_list:
-        return pd.concat(tables_list, ignore_index=True)
-    else:
-        return pd.DataFrame()
-
-
-
-
-def data_to_dataframe(invoice_data, custom_data=None):
-    all_field_data = []
-    all_table_data=[]
-
-    for doc in invoice_data.documents:
-        for field_name, field in doc.fields.items():
-            value = field.content if hasattr(field, 'content') and field.content else 'N/A'
-            confidence = field.confidence if hasattr(field, 'confidence') else 'N/A'
-            all_field_data.append({'Key': field_name, 'Value': value, 'Confidence' : confidence})
-    
-        if hasattr(doc, 'tables'):
-            table_data = extract_table_data(doc)
-            if not table_data.empty:
-                all_table_data.append(table_data)
-
-
-    if custom_data:
-        for doc in custom_data.documents:
-            # print(f"🔍 Document has {len(doc.fields)} fields")
-            for field_name, field in doc.fields.items():
-                value = field.content if hasattr(field, 'content') and field.content else 'N/A'
-                confidence = field.confidence if hasattr(field, 'confidence') else 'N/A'
-                # print(f"🔍 Field: {field_name} = {value} (confidence: {confidence})")
-                if value != 'N/A':
-                    # Add custom fields only if they don't already exist
-                    if field_name not in [data['Key'] for data in all_field_data]:
-                        # print(f"✅ Adding new field: {field_name}")
-                        all_field_data.append({'Key': field_name, 'Value': value, 'Confidence': confidence})
-
-    fields_df = pd.DataFrame(all_field_data)
-    # print(fields_df)
-    tables_df = pd.concat(all_table_data, ignore_index=True) if all_table_data else pd.DataFrame()
-    # print(tables_df)
-    return fields_df, tables_df
- 
-def create_excel(fields_df, table_df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-          current_row = 0
-        
-          if not fields_df.empty:
-                worksheet = writer.book.create_sheet('Invoice_Data')
-                worksheet.cell(row=current_row + 1, column=1).value = "=== INVOICE FIELDS ==="
-                current_row += 2
-                
-                fields_df.to_excel(writer, sheet_name='Invoice_Data', startrow=current_row, index=False)
-                current_row += len(fields_df) + 3  # Add some space
-        
-          if not table_df.empty:
-                if fields_df.empty:
-                    worksheet = writer.book.create_sheet('Invoice_Data')
-                    current_row = 0
-                
-                worksheet.cell(row=current_row + 1, column=1).value = "=== INVOICE TABLES ==="
-                current_row += 2
-                
-                table_df.to_excel(writer, sheet_name='Invoice_Data', startrow=current_row, index=False)
-            
-          if fields_df.empty and table_df.empty:
-                empty_df = pd.DataFrame({'Message': ['No data extracted from the invoice']})
-                empty_df.to_excel(writer, sheet_name='Invoice_Data', index=False)
-            
-          if 'Invoice_Data' in writer.sheets:
-                worksheet = writer.sheets['Invoice_Data']
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-          output.seek(0)
-          return output
 
 if 'fields_df' not in st.session_state:
     st.session_state.fields_df = pd.DataFrame()
 if 'table_df' not in st.session_state:
     st.session_state.table_df = pd.DataFrame()
+if 'items_df' not in st.session_state:
+    st.session_state.items_df = pd.DataFrame()
 if 'ready_to_download' not in st.session_state:
     st.session_state.ready_to_download = False
 
@@ -258,16 +143,36 @@ if uploaded_file:
         # custom_data = analyze_custom_model(uploaded_file)
         # layout_data = layout_invoice(uploaded_file)
         # st.session_state.data_extracted =True
+
+        # Reject or repair bad files locally before spending any remote calls on them
+        try:
+            file_bytes, content_type = preflight_file(uploaded_file.getvalue(), uploaded_file.name)
+        except PreflightError as e:
+            st.error(f"Invoice rejected before analysis: {str(e)}")
+            st.stop()
+
+        # Pages already analyzed in an earlier upload are reused, only changed pages go back to the service
+        hashes = page_hashes(file_bytes, content_type)
+
         progress_bar = st.progress(0)
         status_text = st.empty()
         status_text.text("Analyzing invoice structure...")
-        invoice_data = analyze_invoice(uploaded_file)
+        invoice_data = analyze_with_reuse("prebuilt-invoice", hashes, lambda pages: analyze_invoice(file_bytes, pages))
         progress_bar.progress(33)
-        status_text.text("Processing with custom model...")
-        custom_data = analyze_custom_model(uploaded_file)
+        stats = custom_model_stats()
+        weak_fields = unconfident_fields(invoice_data, required_fields, custom_model_confidence_threshold)
+        if weak_fields:
+            status_text.text(f"Processing with custom model for {', '.join(weak_fields)}...")
+            custom_data = analyze_with_reuse(custom_model_id, hashes,
+                                             lambda pages: analyze_custom_model(file_bytes, content_type, pages))
+            stats['called'] += 1
+        else:
+            custom_data = None
+            stats['skipped'] += 1
         progress_bar.progress(66)
         status_text.text("Extracting tables and layout...")
-        layout_data = layout_invoice(uploaded_file)
+        layout_data = analyze_with_reuse("prebuilt-layout", hashes,
+                                         lambda pages: layout_invoice(file_bytes, content_type, pages))
         progress_bar.progress(100)
         
         status_text.text("Processing complete!")
@@ -278,8 +183,12 @@ if uploaded_file:
         st.session_state.data_extracted = True
 
         if invoice_data and invoice_data.documents:
-            fields_df, _ = data_to_dataframe(invoice_data, custom_data)
+            fields_df, items_df = data_to_dataframe(invoice_data, custom_data,
+                                                    custom_model_confidence_threshold)
             st.session_state.fields_df = fields_df
+            # Kept unedited so Finalize Edits can tell which values the reviewer corrected
+            st.session_state.extracted_fields_df = fields_df
+            st.session_state.items_df = items_df
 
         # if custom_data and custom_data.documents:
         #     for doc in custom_data.documents:
@@ -292,12 +201,34 @@ if uploaded_file:
             table_df = extract_table_data(layout_data)
             st.session_state.table_df = table_df
             # st.write(f"Table extraction: {'✅ Success' if not table_df.empty else '❌ No tables found'}")
+
+        # Persist every extraction so it can be searched later without re-analyzing
+        if not (st.session_state.fields_df.empty and st.session_state.items_df.empty and st.session_state.table_df.empty):
+            try:
+                # Uploading the same invoice again, or a revision of it, updates its row instead of adding one
+                st.session_state.invoice_pk = save_extraction(uploaded_file.name, st.session_state.fields_df,
+                                                              st.session_state.items_df, st.session_state.table_df,
+                                                              file_hash=hashlib.sha256(file_bytes).hexdigest())
+            except Exception as e:
+                st.error(f"Error saving invoice to the search index: {str(e)}")
+    stats = custom_model_stats()
+    total_routed = stats['called'] + stats['skipped']
+    if total_routed:
+        st.caption(f"Custom model skipped for {stats['skipped']} of {total_routed} invoices "
+                   f"({stats['skipped'] / total_routed:.0%}), threshold {custom_model_confidence_threshold:.2f}")
+
     if not st.session_state.fields_df.empty:
         st.write("Extracted Field Data:")
         edited_fields = st.data_editor(st.session_state.fields_df, num_rows = "dynamic", key = "fields_editor", 
                                                     use_container_width=True)
         st.session_state.fields_df = edited_fields
 
+    if not st.session_state.items_df.empty:
+        st.write("Extracted Line Items:")
+        edited_items = st.data_editor(st.session_state.items_df, num_rows="dynamic", key = "items_editor",
+                                                  use_container_width=True)
+        st.session_state.items_df = edited_items
+
     if not st.session_state.table_df.empty:
         st.write("Extracted Table data:")
         edited_tables = st.data_editor(st.session_state.table_df,num_rows="dynamic", key = "table_editor",
@@ -306,18 +237,25 @@ if uploaded_file:
 
     if st.button('Finalize Edits'):
         st.session_state.ready_to_download = True
+        st.session_state.fields_df = retype_edited_fields(
+            st.session_state.fields_df, st.session_state.get('extracted_fields_df', pd.DataFrame()))
+        if st.session_state.get('invoice_pk'):
+            save_extraction(uploaded_file.name, st.session_state.fields_df, st.session_state.items_df,
+                            st.session_state.table_df, invoice_pk=st.session_state.invoice_pk)
         st.success("Edits finalized. You can now download the Excel File")
     
     if st.button("Current Data Status"):
         st.write("**Current Fields Data:**")
         st.write(st.session_state.fields_df)
+        st.write("**Current Line Items:**")
+        st.write(st.session_state.items_df)
         st.write("**Current Table Data:**")
         st.write(st.session_state.table_df)
         # st.write(f"Ready to download: {st.session_state.ready_to_download}")
 
     if st.session_state.ready_to_download:
         # combined_df = pd.concat([st.session_state.fields_df ,st.session_state.table_df ],ignore_index=True)
-        excel_file = create_excel(st.session_state.fields_df ,st.session_state.table_df)
+        excel_file = create_excel(st.session_state.fields_df ,st.session_state.table_df, st.session_state.items_df)
         st.download_button(
             label="Download Excel file",
             data=excel_file,
@@ -328,9 +266,15 @@ else:
     st.info("Please upload a PDF file to extract data")
     if 'data_extracted' in st.session_state:
         del st.session_state.data_extracted
+    if 'invoice_pk' in st.session_state:
+        del st.session_state.invoice_pk
+    if 'extracted_fields_df' in st.session_state:
+        del st.session_state.extracted_fields_df
     if 'fields_df' in st.session_state:
         st.session_state.fields_df = pd.DataFrame()
     if 'table_df' in st.session_state:
         st.session_state.table_df = pd.DataFrame()
+    if 'items_df' in st.session_state:
+        st.session_state.items_df = pd.DataFrame()
     if 'ready_to_download' in st.session_state:
         st.session_state.ready_to_download = False
@@ -0,0 +1,275 @@
+import hashlib
+import json
+from io import BytesIO
+
+from azure.ai.documentintelligence.models import AnalyzeResult as IntelligenceAnalyzeResult
+from azure.ai.formrecognizer import AnalyzeResult as RecognizerAnalyzeResult
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from invoice_index import INDEX_PATH, find_analysis, save_analysis
+
+
+# Below this share of unchanged pages a full run is cheaper to reason about than splicing
+MIN_REUSED_FRACTION = 0.5
+# Form field parents are followed at most this far, a malformed /Parent chain can loop
+MAX_FIELD_DEPTH = 32
+
+
+def object_bytes(value):
+    # Deterministic bytes for a PDF object, streams contribute their raw encoded data.
+    # Decoding would need jbig2dec for JBIG2 scans and inflate every image on each upload
+    value = value.get_object() if isinstance(value, IndirectObject) else value
+    if isinstance(value, StreamObject):
+        return value._data
+    if isinstance(value, ArrayObject):
+        return b'[' + b' '.join(object_bytes(item) for item in value) + b']'
+    return str(value).encode()
+
+
+def visit(reference, seen):
+    # Objects shared between pages, forms and annotations are hashed once, which also stops cycles
+    key = getattr(reference, 'idnum', None)
+    if key in seen:
+        return None
+    if key is not None:
+        seen.add(key)
+    return reference.get_object()
+
+
+def hash_fonts(digest, fonts, seen):
+    # A replaced font or ToUnicode map changes the extracted text while the content stream stays the same
+    for name, reference in sorted(fonts.get_object().items()):
+        digest.update(name.encode())
+        font = visit(reference, seen)
+        if not isinstance(font, DictionaryObject):
+            continue
+        for key in ('/Subtype', '/BaseFont', '/Encoding', '/ToUnicode'):
+            digest.update(object_bytes(font.get(key)))
+        descriptor = font.get('/FontDescriptor')
+        descriptor = descriptor.get_object() if descriptor is not None else None
+        if isinstance(descriptor, DictionaryObject):
+            for key in ('/FontFile', '/FontFile2', '/FontFile3'):
+                if key in descriptor:
+                    digest.update(object_bytes(descriptor[key]))
+
+
+def hash_resources(digest, resources, seen):
+    resources = resources.get_object() if resources is not None else None
+    if not isinstance(resources, DictionaryObject):
+        return
+    fonts = resources.get('/Font')
+    if fonts is not None:
+        hash_fonts(digest, fonts, seen)
+    # Swapping a scanned image keeps the content stream identical, so hash the images it draws too
+    xobjects = resources.get('/XObject')
+    if xobjects is None:
+        return
+    for name, reference in sorted(xobjects.get_object().items()):
+        digest.update(name.encode())
+        xobject = visit(reference, seen)
+        if not isinstance(xobject, StreamObject):
+            continue
+        digest.update(object_bytes(xobject))
+        # Form XObjects can draw each other, the nested ones are hashed too
+        if xobject.get('/Subtype') == '/Form':
+            hash_resources(digest, xobject.get('/Resources'), seen)
+
+
+def field_attributes(annotation):
+    # A widget's type and value can be inherited from its parent field, its full name joins every /T up the chain
+    attributes = {}
+    names = []
+    node = annotation
+    for _ in range(MAX_FIELD_DEPTH):
+        for key in ('/FT', '/V'):
+            if attributes.get(key) is None and key in node:
+                attributes[key] = node[key]
+        if '/T' in node:
+            names.append(str(node['/T']))
+        parent = node.get('/Parent')
+        node = parent.get_object() if parent is not None else None
+        if not isinstance(node, DictionaryObject):
+            break
+    attributes['/T'] = '.'.join(reversed(names))
+    return attributes
+
+
+def hash_appearances(digest, annotations, seen):
+    annotations = annotations.get_object()
+    if not isinstance(annotations, ArrayObject):
+        return
+    for annotation in annotations:
+        annotation = annotation.get_object()
+        if not isinstance(annotation, DictionaryObject):
+            continue
+        for key in ('/Subtype', '/Rect', '/AS'):
+            digest.update(object_bytes(annotation.get(key)))
+        # With NeedAppearances a filled field may have no appearance stream, only the value in /V
+        for key, value in sorted(field_attributes(annotation).items()):
+            digest.update(key.encode())
+            digest.update(object_bytes(value))
+        appearance = annotation.get('/AP')
+        appearance = appearance.get_object() if appearance is not None else None
+        if not isinstance(appearance, DictionaryObject):
+            continue
+        for kind, entry in sorted(appearance.items()):
+            entry = entry.get_object()
+            # An entry is either one stream or a dictionary of streams keyed by state, e.g. checkbox /On and /Off
+            if isinstance(entry, StreamObject):
+                states = [(kind, entry)]
+            elif isinstance(entry, DictionaryObject):
+                states = sorted(entry.items())
+            else:
+                continue
+            for state, stream in states:
+                stream = stream.get_object()
+                digest.update(state.encode())
+                digest.update(object_bytes(stream))
+                if isinstance(stream, StreamObject):
+                    hash_resources(digest, stream.get('/Resources'), seen)
+
+
+def page_hashes(file_bytes, content_type):
+    if content_type != 'application/pdf':
+        return [hashlib.sha256(file_bytes).hexdigest()]
+
+    hashes = []
+    try:
+        for page in PdfReader(BytesIO(file_bytes)).pages:
+            digest = hashlib.sha256(f"{page.mediabox} {page.rotation}".encode())
+            contents = page.get('/Contents')
+            if contents is not None:
+                contents = contents.get_object()
+                for stream in (contents if isinstance(contents, list) else [contents]):
+                    digest.update(object_bytes(stream))
+            seen = set()
+            hash_resources(digest, page.get('/Resources'), seen)
+            annotations = page.get('/Annots')
+            if annotations is not None:
+                hash_appearances(digest, annotations, seen)
+            hashes.append(digest.hexdigest())
+    except Exception:
+        # The service may still read a file pypdf trips over, a whole-file hash just means a full analysis
+        return [hashlib.sha256(file_bytes).hexdigest()]
+    return hashes
+
+
+def changed_pages(old_hashes, new_hashes):
+    # 1-based like the service; pages beyond the new length were removed and count as changed
+    page_count = max(len(old_hashes), len(new_hashes))
+    return [number for number in range(1, page_count + 1)
+            if number > len(old_hashes) or number > len(new_hashes)
+            or old_hashes[number - 1] != new_hashes[number - 1]]
+
+
+def page_range(page_numbers):
+    return ','.join(str(number) for number in page_numbers)
+
+
+def region_pages(element):
+    return {region.page_number for region in (getattr(element, 'bounding_regions', None) or [])}
+
+
+def serialize_result(result):
+    if hasattr(result, 'as_dict'):
+        return 'documentintelligence', json.dumps(result.as_dict(), default=str)
+    return 'formrecognizer', json.dumps(result.to_dict(), default=str)
+
+
+def deserialize_result(sdk, payload):
+    data = json.loads(payload)
+    if sdk == 'documentintelligence':
+        return IntelligenceAnalyzeResult(data)
+    return RecognizerAnalyzeResult.from_dict(data)
+
+
+def list_attribute(field):
+    if isinstance(getattr(field, 'value', None), list):
+        return 'value'
+    if isinstance(getattr(field, 'value_array', None), list):
+        return 'value_array'
+    return None
+
+
+def splice_fields(old_fields, new_fields, changed):
+    fields = {}
+    for field_name in list(old_fields) + [name for name in new_fields if name not in old_fields]:
+        old_field = old_fields.get(field_name)
+        new_field = new_fields.get(field_name)
+        attr = list_attribute(old_field) or list_attribute(new_field)
+        if attr:
+            # Line items: keep rows from untouched pages and take the rest from the re-analysis
+            base = old_field if old_field is not None else new_field
+            items = [item for item in (getattr(old_field, attr, None) or []) if not region_pages(item) & changed]
+            items += getattr(new_field, attr, None) or []
+            items.sort(key=lambda item: min(region_pages(item), default=0))
+            setattr(base, attr, items)
+            fields[field_name] = base
+        elif old_field is not None and region_pages(old_field) and not region_pages(old_field) & changed:
+            fields[field_name] = old_field
+        elif new_field is not None:
+            fields[field_name] = new_field
+    return fields
+
+
+def splice_result(old_result, new_result, changed, page_count):
+    changed = set(changed)
+
+    pages = [page for page in (old_result.pages or []) if page.page_number not in changed]
+    tables = [table for table in (getattr(old_result, 'tables', None) or []) if not region_pages(table) & changed]
+    if new_result is not None:
+        pages += new_result.pages or []
+        tables += getattr(new_result, 'tables', None) or []
+    old_result.pages = sorted((page for page in pages if page.page_number <= page_count), key=lambda page: page.page_number)
+    if getattr(old_result, 'tables', None) is not None or tables:
+        old_result.tables = sorted(tables, key=lambda table: min(region_pages(table), default=0))
+
+    old_documents = old_result.documents or []
+    new_documents = (new_result.documents or []) if new_result is not None else []
+    for index, old_doc in enumerate(old_documents):
+        new_fields = new_documents[index].fields if index < len(new_documents) else {}
+        old_doc.fields = splice_fields(old_doc.fields, new_fields, changed)
+    if len(new_documents) > len(old_documents):
+        old_result.documents = list(old_documents) + list(new_documents[len(old_documents):])
+    return old_result
+
+
+def plan_reanalysis(model_id, hashes, db_path=INDEX_PATH):
+    previous = find_analysis(model_id, hashes, db_path=db_path)
+    if previous is None:
+        return None, None, None
+    sdk, payload, old_hashes = previous
+    changed = changed_pages(old_hashes, hashes)
+    reused = len(hashes) - len([number for number in changed if number <= len(hashes)])
+    if reused < len(hashes) * MIN_REUSED_FRACTION:
+        return None, None, None
+    pages_to_analyze = [number for number in changed if number <= len(hashes)]
+    return deserialize_result(sdk, payload), pages_to_analyze, changed
+
+
+def finish_reanalysis(model_id, hashes, previous_result, new_result, changed, db_path=INDEX_PATH):
+    if previous_result is None:
+        result = new_result
+    elif not changed:
+        # Identical to the stored analysis, nothing new to save
+        return previous_result
+    elif new_result is None and any(number <= len(hashes) for number in changed):
+        # The partial analysis failed, there is nothing safe to splice
+        return None
+    else:
+        result = splice_result(previous_result, new_result, changed, len(hashes))
+    if result is not None:
+        save_analysis(model_id, hashes, *serialize_result(result), db_path=db_path)
+    return result
+
+
+def analyze_with_reuse(model_id, hashes, analyze, db_path=INDEX_PATH):
+    previous_result, pages_to_analyze, changed = plan_reanalysis(model_id, hashes, db_path)
+    if previous_result is None:
+        new_result = analyze(None)
+    elif pages_to_analyze:
+        new_result = analyze(page_range(pages_to_analyze))
+    else:
+        new_result = None
+    return finish_reanalysis(model_id, hashes, previous_result, new_result, changed, db_path)
@@ -14,6 +14,8 @@ from azure.cognitiveservices.vision.computervision.models import OperationStatus
 from msrest.authentication import CognitiveServicesCredentials
 from openai import AzureOpenAI
 
+from invoice_processing import extract_table_data
+
 
 # Load configuration
 config_path = 'config.json'
@@ -81,41 +83,6 @@ def layout_invoice(uploaded_file):
         return None
 
 
-def flatten_data(field, prefix=''):
-    flat_data = {}
-    if hasattr(field, 'value') and isinstance(field.value, dict):
-        for sub_key, sub_field in field.value.items():
-            flat_data.update(flatten_data(sub_field, prefix=f"{prefix}{sub_key}_"))
-        print("flat_data_dict", flat_data)
-    else:
-        content = getattr(field, 'content', 'N/A') if hasattr(field, 'content') else 'N/A'
-        flat_data[prefix.rstrip('_')] = content
-    return flat_data
-
-        
-def extract_table_data(document):
-    tables_list = []
-
-    if hasattr(document, 'tables'):
-        for table in document.tables:
-            table_data = []
-            for cell in table.cells:
-                if len(table_data) <= cell.row_index:
-                    table_data.extend([{} for _ in range(cell.row_index + 1 - len(table_data))])
-                column_header = f"Column {cell.column_index}" 
-                table_data[cell.row_index][column_header] = cell.content
-            if table_data:
-                df = pd.DataFrame(table_data)
-                tables_list.append(df)
-
-    if tables_list:
-        return pd.concat(tables_list, ignore_index=True)
-    else:
-        return pd.DataFrame()
-
-
-
-
 def data_to_dataframe(invoice_data):
     all_field_data = []
     all_table_data=[]
@@ -131,9 +98,7 @@ def data_to_dataframe(invoice_data):
             if not table_data.empty:
                 all_table_data.append(table_data)
     fields_df = pd.DataFrame(all_field_data)
-    print(fields_df)
     tables_df = pd.concat(all_table_data, ignore_index=True) if all_table_data else pd.DataFrame()
-    print(tables_df)
     return fields_df, tables_df
 
 
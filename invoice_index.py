@@ -0,0 +1,278 @@
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+from io import StringIO
+
+import pandas as pd
+
+
+INDEX_PATH = os.environ.get('INVOICE_INDEX_PATH', 'invoice_index.db')
+# Stored analyses kept per model for page reuse, layout results of long PDFs run to megabytes each
+ANALYSIS_RETENTION = int(os.environ.get('INVOICE_ANALYSIS_RETENTION', 1000))
+# Seconds a save waits for other sessions' writes, sqlite3's default of 5 runs out with a few dozen reviewers saving
+WRITE_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    filename TEXT,
+    file_hash TEXT,
+    vendor_name TEXT COLLATE NOCASE,
+    customer_name TEXT COLLATE NOCASE,
+    invoice_id TEXT,
+    invoice_date TEXT,
+    invoice_total REAL,
+    currency TEXT,
+    created_at TEXT,
+    version INTEGER,
+    fields_json TEXT,
+    items_json TEXT,
+    tables_json TEXT
+);
+CREATE INDEX IF NOT EXISTS invoices_vendor_date ON invoices (vendor_name, invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_date ON invoices (invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_total ON invoices (invoice_total);
+CREATE INDEX IF NOT EXISTS invoices_invoice_id ON invoices (invoice_id);
+CREATE INDEX IF NOT EXISTS invoices_file_hash ON invoices (file_hash);
+CREATE INDEX IF NOT EXISTS invoices_created_at ON invoices (created_at);
+CREATE INDEX IF NOT EXISTS invoices_version ON invoices (version);
+CREATE VIRTUAL TABLE IF NOT EXISTS invoice_text USING fts5(invoice_pk UNINDEXED, source UNINDEXED, text);
+CREATE TABLE IF NOT EXISTS analysis_results (
+    id INTEGER PRIMARY KEY,
+    model_id TEXT,
+    sdk TEXT,
+    page_hashes TEXT,
+    result_json TEXT,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS analysis_pages (
+    result_id INTEGER,
+    page_number INTEGER,
+    page_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS analysis_pages_hash ON analysis_pages (page_hash);
+CREATE INDEX IF NOT EXISTS analysis_pages_result ON analysis_pages (result_id);
+CREATE INDEX IF NOT EXISTS analysis_results_model ON analysis_results (model_id, id);
+"""
+
+# Columns of the invoices table and the prebuilt-invoice field each one is read from
+KEY_FIELDS = {
+    'vendor_name': 'VendorName',
+    'customer_name': 'CustomerName',
+    'invoice_id': 'InvoiceId',
+}
+
+# Every write stamps the row with the next version, readers pick up changes with version > last seen
+NEXT_VERSION = "(SELECT COALESCE(MAX(version), 0) + 1 FROM invoices)"
+
+RESULT_COLUMNS = ['id', 'filename', 'vendor_name', 'customer_name', 'invoice_id', 'invoice_date',
+                  'invoice_total', 'currency', 'created_at']
+
+# Database files this process has already set up
+initialized_paths = set()
+
+
+def connect(db_path=INDEX_PATH):
+    conn = sqlite3.connect(db_path, timeout=WRITE_TIMEOUT)
+    # The schema and WAL mode persist in the file, set them up once per process instead of on every connection
+    if db_path not in initialized_paths:
+        # WAL lets the search page and API read while an extraction is being written
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        initialized_paths.add(db_path)
+    return conn
+
+
+def field_lookup(fields_df, key, column):
+    if fields_df.empty or column not in fields_df.columns:
+        return None
+    matches = fields_df.loc[fields_df['Key'] == key, column].dropna()
+    if matches.empty:
+        return None
+    value = matches.iloc[0]
+    return None if value == 'N/A' else value
+
+
+def key_columns(fields_df):
+    columns = {column: field_lookup(fields_df, key, 'Value') for column, key in KEY_FIELDS.items()}
+    invoice_date = field_lookup(fields_df, 'InvoiceDate', 'Date')
+    columns['invoice_date'] = pd.Timestamp(invoice_date).strftime('%Y-%m-%d') if invoice_date is not None else None
+    invoice_total = field_lookup(fields_df, 'InvoiceTotal', 'Amount')
+    columns['invoice_total'] = float(invoice_total) if invoice_total is not None else None
+    columns['currency'] = field_lookup(fields_df, 'InvoiceTotal', 'Currency')
+    return columns
+
+
+def text_rows(invoice_pk, fields_df, items_df):
+    rows = []
+    if not fields_df.empty:
+        for key, value in zip(fields_df['Key'], fields_df['Value']):
+            if pd.notna(value) and value != 'N/A':
+                rows.append((invoice_pk, key, str(value)))
+    if not items_df.empty:
+        for position, item in enumerate(items_df.itertuples(index=False), start=1):
+            text = ' '.join(str(value) for value in item if pd.notna(value))
+            rows.append((invoice_pk, f"Items_{position}", text))
+    return rows
+
+
+def find_duplicate(conn, file_hash, vendor_name, invoice_id):
+    # The same file uploaded again, or a revision of it that keeps the vendor and invoice number
+    row = conn.execute(
+        "SELECT id FROM invoices WHERE file_hash = ? OR (vendor_name = ? AND invoice_id = ?) ORDER BY id DESC LIMIT 1",
+        (file_hash, vendor_name, invoice_id)).fetchone()
+    return row[0] if row is not None else None
+
+
+def save_extraction(filename, fields_df, items_df, table_df, invoice_pk=None, file_hash=None, db_path=INDEX_PATH):
+    columns = key_columns(fields_df)
+    columns.update({
+        'filename': filename,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'fields_json': fields_df.to_json(orient='split', date_format='iso'),
+        'items_json': items_df.to_json(orient='split', date_format='iso'),
+        'tables_json': table_df.to_json(orient='split', date_format='iso'),
+    })
+    # Re-saves after edits do not have the file at hand, they keep the stored hash
+    if file_hash is not None:
+        columns['file_hash'] = file_hash
+
+    with closing(connect(db_path)) as conn, conn:
+        # Take the write lock up front so two uploads of the same invoice cannot both miss the duplicate check
+        conn.execute("BEGIN IMMEDIATE")
+        if invoice_pk is None:
+            invoice_pk = find_duplicate(conn, file_hash, columns['vendor_name'], columns['invoice_id'])
+        if invoice_pk is None:
+            names = ', '.join(columns)
+            placeholders = ', '.join('?' for _ in columns)
+            # The version is computed inside the write transaction, SQLite's single writer keeps it unique and ordered
+            cursor = conn.execute(f"INSERT INTO invoices ({names}, version) VALUES ({placeholders}, {NEXT_VERSION})",
+                                  list(columns.values()))
+            invoice_pk = cursor.lastrowid
+        else:
+            # Re-saving after edits replaces the stored row and its search text
+            assignments = ', '.join(f"{name} = ?" for name in columns)
+            conn.execute(f"UPDATE invoices SET {assignments}, version = {NEXT_VERSION} WHERE id = ?",
+                         [*columns.values(), invoice_pk])
+            conn.execute("DELETE FROM invoice_text WHERE invoice_pk = ?", (invoice_pk,))
+        conn.executemany("INSERT INTO invoice_text (invoice_pk, source, text) VALUES (?, ?, ?)",
+                         text_rows(invoice_pk, fields_df, items_df))
+    return invoice_pk
+
+
+def fts_query(text):
+    # Quote every term so user input cannot be parsed as FTS5 operators
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+def search_invoices(vendor=None, min_total=None, max_total=None, date_from=None, date_to=None, text=None,
+                    limit=100, db_path=INDEX_PATH):
+    clauses = []
+    params = []
+    if vendor:
+        # Prefix LIKE on a NOCASE column can still use the vendor index
+        clauses.append("vendor_name LIKE ?")
+        params.append(f"{vendor}%")
+    if min_total is not None:
+        clauses.append("invoice_total >= ?")
+        params.append(min_total)
+    if max_total is not None:
+        clauses.append("invoice_total <= ?")
+        params.append(max_total)
+    if date_from is not None:
+        clauses.append("invoice_date >= ?")
+        params.append(pd.Timestamp(date_from).strftime('%Y-%m-%d'))
+    if date_to is not None:
+        clauses.append("invoice_date <= ?")
+        params.append(pd.Timestamp(date_to).strftime('%Y-%m-%d'))
+    if text and text.strip():
+        clauses.append("id IN (SELECT invoice_pk FROM invoice_text WHERE invoice_text MATCH ?)")
+        params.append(fts_query(text))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    query = f"SELECT {', '.join(RESULT_COLUMNS)} FROM invoices {where} ORDER BY invoice_date DESC, id DESC LIMIT ?"
+    params.append(limit)
+    with closing(connect(db_path)) as conn:
+        return pd.read_sql_query(query, conn, params=params)
+
+
+def save_analysis(model_id, hashes, sdk, result_json, keep=ANALYSIS_RETENTION, db_path=INDEX_PATH):
+    with closing(connect(db_path)) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO analysis_results (model_id, sdk, page_hashes, result_json, created_at) VALUES (?, ?, ?, ?, ?)",
+            (model_id, sdk, json.dumps(hashes), result_json, datetime.now(timezone.utc).isoformat(timespec='seconds')))
+        conn.executemany("INSERT INTO analysis_pages (result_id, page_number, page_hash) VALUES (?, ?, ?)",
+                         [(cursor.lastrowid, number, page_hash) for number, page_hash in enumerate(hashes, start=1)])
+        # Only the newest results of each model are kept, older revisions are rarely uploaded again
+        expired = "SELECT id FROM analysis_results WHERE model_id = ? ORDER BY id DESC LIMIT -1 OFFSET ?"
+        conn.execute(f"DELETE FROM analysis_pages WHERE result_id IN ({expired})", (model_id, keep))
+        conn.execute(f"DELETE FROM analysis_results WHERE id IN ({expired})", (model_id, keep))
+        return cursor.lastrowid
+
+
+def find_analysis(model_id, hashes, db_path=INDEX_PATH):
+    # The stored result of this model sharing the most pages with the new file, newest first on ties
+    if not hashes:
+        return None
+    placeholders = ', '.join('?' for _ in hashes)
+    query = f"""
+        SELECT r.sdk, r.result_json, r.page_hashes FROM analysis_pages p
+        JOIN analysis_results r ON r.id = p.result_id
+        WHERE r.model_id = ? AND p.page_hash IN ({placeholders})
+        GROUP BY r.id ORDER BY COUNT(*) DESC, r.id DESC LIMIT 1"""
+    with closing(connect(db_path)) as conn:
+        row = conn.execute(query, [model_id, *hashes]).fetchone()
+    if row is None:
+        return None
+    sdk, result_json, page_hashes = row
+    return sdk, result_json, json.loads(page_hashes)
+
+
+def read_frame(payload):
+    # No dtype inference, it turns invoice numbers like '0042' into 42; only the date columns are parsed back
+    frame = pd.read_json(StringIO(payload), orient='split', dtype=False, convert_dates=False)
+    for column in frame.columns:
+        if str(column).endswith('Date'):
+            frame[column] = pd.to_datetime(frame[column], errors='coerce')
+    return frame
+
+
+def load_extractions_since(since_version=None, db_path=INDEX_PATH):
+    query = "SELECT id, version, fields_json, items_json FROM invoices"
+    params = []
+    if since_version is not None:
+        query += " WHERE version > ?"
+        params.append(since_version)
+    with closing(connect(db_path)) as conn:
+        rows = pd.read_sql_query(query + " ORDER BY version", conn, params=params)
+    rows['fields_df'] = [read_frame(payload) for payload in rows['fields_json']]
+    rows['items_df'] = [read_frame(payload) for payload in rows['items_json']]
+    return rows.drop(columns=['fields_json', 'items_json'])
+
+
+def invoice_ids(db_path=INDEX_PATH):
+    with closing(connect(db_path)) as conn:
+        return [invoice_pk for (invoice_pk,) in conn.execute("SELECT id FROM invoices ORDER BY id")]
+
+
+def iter_extractions(invoice_pks=None, db_path=INDEX_PATH):
+    # Yields (filename, fields_df, table_df, items_df) one invoice at a time so callers never hold the whole batch
+    query = "SELECT filename, fields_json, tables_json, items_json FROM invoices"
+    params = []
+    if invoice_pks is not None:
+        query += f" WHERE id IN ({', '.join('?' for _ in invoice_pks)})"
+        params.extend(invoice_pks)
+    with closing(connect(db_path)) as conn:
+        for filename, *payloads in conn.execute(query + " ORDER BY id", params):
+            yield (filename or 'Invoice', *(read_frame(payload) for payload in payloads))
+
+
+def load_extraction(invoice_pk, db_path=INDEX_PATH):
+    with closing(connect(db_path)) as conn:
+        row = conn.execute("SELECT fields_json, items_json, tables_json FROM invoices WHERE id = ?",
+                           (invoice_pk,)).fetchone()
+    if row is None:
+        return None
+    return tuple(read_frame(payload) for payload in row)
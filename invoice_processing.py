@@ -0,0 +1,229 @@
+import re
+
+import pandas as pd
+
+
+# prebuilt-invoice currency fields, used to type a corrected value that the service had left empty
+AMOUNT_FIELDS = {'InvoiceTotal', 'SubTotal', 'TotalTax', 'AmountDue', 'PreviousUnpaidBalance', 'TotalDiscount'}
+
+
+def field_children(field):
+    # formrecognizer fields carry nested data in .value, documentintelligence in value_object/value_array/value_address
+    value = getattr(field, 'value', None)
+    if value is None:
+        for attr in ('value_object', 'value_array', 'value_address'):
+            value = getattr(field, attr, None)
+            if value is not None:
+                break
+    if value is None:
+        return None
+
+    if isinstance(value, dict):
+        return list(value.items())
+    if isinstance(value, list):
+        return [(str(index), item) for index, item in enumerate(value, start=1)]
+    if getattr(field, 'value_type', None) == 'address' or getattr(field, 'type', None) == 'address':
+        address = value.as_dict() if hasattr(value, 'as_dict') else value.to_dict()
+        return [(sub_key, sub_value) for sub_key, sub_value in address.items() if sub_value is not None]
+    return None
+
+
+def field_content(field):
+    if hasattr(field, 'content'):
+        return field.content if field.content else 'N/A'
+    return str(field)
+
+
+def typed_field_value(field):
+    field_type = getattr(field, 'value_type', None) or getattr(field, 'type', None)
+    value = getattr(field, 'value', None)
+    if field_type == 'currency':
+        currency = value if value is not None else getattr(field, 'value_currency', None)
+        if currency is None:
+            return {}
+        code = getattr(currency, 'code', None) or getattr(currency, 'currency_code', None)
+        return {'Amount': currency.amount, 'Currency': code}
+    if field_type == 'date':
+        return {'Date': value if value is not None else getattr(field, 'value_date', None)}
+    if field_type in ('float', 'int', 'number', 'integer'):
+        if value is None:
+            value = getattr(field, 'value_number', None)
+        if value is None:
+            value = getattr(field, 'value_integer', None)
+        return {'Number': value}
+    return {}
+
+
+def field_value(field):
+    typed = typed_field_value(field)
+    for column in ('Amount', 'Date', 'Number'):
+        if typed.get(column) is not None:
+            return typed[column]
+    content = field_content(field)
+    return content if content != 'N/A' else None
+
+
+def flatten_data(field, prefix='', leaf=field_content):
+    flat_data = {}
+    stack = [(prefix, field)]
+    while stack:
+        key, node = stack.pop()
+        children = field_children(node)
+        if children:
+            # Push in reverse so sub-fields come back out in document order
+            stack.extend((f"{key}{sub_key}_", sub_field) for sub_key, sub_field in reversed(children))
+        else:
+            flat_data[key.rstrip('_')] = leaf(node)
+    return flat_data
+
+
+def extract_line_items(invoice_data):
+    line_items = []
+    for doc in invoice_data.documents:
+        items_field = doc.fields.get('Items')
+        if items_field is None:
+            continue
+        for _, item in field_children(items_field) or []:
+            line_items.append(flatten_data(item, leaf=field_value))
+
+    # Typed leaves let pandas infer float columns for amounts and quantities, only dates need converting
+    items_df = pd.DataFrame(line_items)
+    for column in items_df.columns:
+        if column.endswith('Date'):
+            items_df[column] = pd.to_datetime(items_df[column], errors='coerce')
+    return items_df
+
+
+def field_rows(field_name, field):
+    value = field_content(field)
+    confidence = field.confidence if hasattr(field, 'confidence') else 'N/A'
+    rows = [{'Key': field_name, 'Value': value, 'Confidence': confidence, **typed_field_value(field)}]
+    if field_children(field):
+        for sub_key, sub_value in flatten_data(field, prefix=f"{field_name}_").items():
+            rows.append({'Key': sub_key, 'Value': sub_value, 'Confidence': confidence})
+    return rows
+
+
+def normalize_fields(fields_df):
+    if fields_df.empty:
+        return fields_df
+    fields_df = fields_df.reindex(columns=['Key', 'Value', 'Confidence', 'Amount', 'Currency', 'Date', 'Number'])
+    fields_df['Confidence'] = pd.to_numeric(fields_df['Confidence'], errors='coerce')
+    fields_df['Amount'] = pd.to_numeric(fields_df['Amount'], errors='coerce')
+    fields_df['Number'] = pd.to_numeric(fields_df['Number'], errors='coerce')
+    fields_df['Date'] = pd.to_datetime(fields_df['Date'], errors='coerce')
+    return fields_df
+
+
+def parse_amount(text):
+    cleaned = re.sub(r'[^\d.,-]', '', str(text))
+    if ',' in cleaned and '.' in cleaned:
+        # Whichever separator comes last is the decimal point, 1,234.56 and 1.234,56 are both common
+        if cleaned.rfind(',') > cleaned.rfind('.'):
+            cleaned = cleaned.replace('.', '').replace(',', '.')
+        else:
+            cleaned = cleaned.replace(',', '')
+    elif ',' in cleaned:
+        head, _, tail = cleaned.rpartition(',')
+        cleaned = f"{head.replace(',', '')}.{tail}" if len(tail) == 2 else cleaned.replace(',', '')
+    return pd.to_numeric(cleaned, errors='coerce')
+
+
+def retype_edited_fields(fields_df, extracted_df):
+    # Reviewers correct the Value column, the typed columns the index reads must follow those corrections
+    if fields_df.empty or 'Value' not in fields_df.columns:
+        return fields_df
+    fields_df = normalize_fields(fields_df.copy())
+    original = extracted_df['Value'].reindex(fields_df.index) if not extracted_df.empty else None
+    for index, row in fields_df.iterrows():
+        value = row['Value']
+        if original is not None and value == original.get(index):
+            continue
+        missing = pd.isna(value) or value == 'N/A'
+        if pd.notna(row['Date']) or str(row['Key']).endswith('Date'):
+            fields_df.at[index, 'Date'] = pd.NaT if missing else pd.to_datetime(value, errors='coerce')
+        elif pd.notna(row['Amount']) or row['Key'] in AMOUNT_FIELDS:
+            fields_df.at[index, 'Amount'] = None if missing else parse_amount(value)
+            code = None if missing else re.search(r'\b[A-Z]{3}\b', str(value))
+            if code:
+                fields_df.at[index, 'Currency'] = code.group()
+        elif pd.notna(row['Number']):
+            fields_df.at[index, 'Number'] = None if missing else parse_amount(value)
+    return fields_df
+
+
+def unconfident_fields(invoice_data, required_fields, threshold):
+    if not invoice_data or not invoice_data.documents:
+        return list(required_fields)
+
+    best_confidence = {}
+    for doc in invoice_data.documents:
+        for field_name in required_fields:
+            field = doc.fields.get(field_name)
+            if field is not None and field_content(field) != 'N/A':
+                confidence = field.confidence or 0.0
+                best_confidence[field_name] = max(best_confidence.get(field_name, 0.0), confidence)
+    return [field_name for field_name in required_fields if best_confidence.get(field_name, 0.0) < threshold]
+
+
+def extract_table_data(document):
+    tables_list = []
+
+    if hasattr(document, 'tables'):
+        for table in document.tables:
+            table_data = []
+            for cell in table.cells:
+                if len(table_data) <= cell.row_index:
+                    table_data.extend([{} for _ in range(cell.row_index + 1 - len(table_data))])
+                column_header = f"Column {cell.column_index}" 
+                table_data[cell.row_index][column_header] = cell.content
+            if table_data:
+                df = pd.DataFrame(table_data)
+                tables_list.append(df)
+
+    if tables_list:
+        return pd.concat(tables_list, ignore_index=True)
+    else:
+        return pd.DataFrame()
+
+
+def row_confidence(rows):
+    confidence = rows[0]['Confidence']
+    return confidence if isinstance(confidence, (int, float)) else 0.0
+
+
+def data_to_dataframe(invoice_data, custom_data=None, threshold=None):
+    # Rows are kept grouped per field so a custom value can replace a field together with its sub-rows
+    field_groups = []
+
+    for doc in invoice_data.documents:
+        for field_name, field in doc.fields.items():
+            # Line items go to their own DataFrame instead of one unreadable row
+            if field_name == 'Items':
+                continue
+            field_groups.append((field_name, field_rows(field_name, field)))
+
+    if custom_data:
+        existing_keys = {row['Key'] for _, rows in field_groups for row in rows}
+        for doc in custom_data.documents:
+            for field_name, field in doc.fields.items():
+                if field_name == 'Items' or field_content(field) == 'N/A':
+                    continue
+                rows = field_rows(field_name, field)
+                if field_name not in existing_keys:
+                    field_groups.append((field_name, rows))
+                    existing_keys.update(row['Key'] for row in rows)
+                elif threshold is not None:
+                    # The custom model is called for low-confidence fields too, so its value wins when it is surer
+                    for position, (group_name, group_rows) in enumerate(field_groups):
+                        if (group_name == field_name and row_confidence(group_rows) < threshold
+                                and row_confidence(rows) > row_confidence(group_rows)):
+                            field_groups[position] = (field_name, rows)
+                            existing_keys.update(row['Key'] for row in rows)
+
+    fields_df = normalize_fields(pd.DataFrame([row for _, rows in field_groups for row in rows]))
+    items_df = extract_line_items(invoice_data)
+    # A custom model trained on line items fills in when prebuilt-invoice found none
+    if items_df.empty and custom_data:
+        items_df = extract_line_items(custom_data)
+    return fields_df, items_df
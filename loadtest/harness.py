@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import streamlit as st
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject
+from streamlit import config
+from streamlit.components.v2.component_manager import BidiComponentManager
+from streamlit.logger import set_log_level
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.pages_manager import PagesManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+from loadtest.mock_service import MockService, start_server
+
+
+APP_PATH = Path(__file__).resolve().parent.parent / 'final.py'
+
+# One entry per script run a reviewer triggers, in the order they happen
+STAGES = ['open', 'extract', 'edit', 'finalize', 'clear', 'upload']
+
+
+def sample_pdf(page_count, upload=None):
+    writer = PdfWriter()
+    for _ in range(page_count):
+        page = writer.add_blank_page(width=612, height=792)
+        if upload is not None:
+            # A comment in the content stream is enough to give every page of this upload its own hash
+            contents = DecodedStreamObject()
+            contents.set_data(f"% upload {upload}\n".encode())
+            page.replace_contents(contents)
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+class SessionRuntime(Runtime):
+    pass
+
+
+class SessionPagesManager(PagesManager):
+    pass
+
+
+def share_app_test_globals(secrets):
+    # AppTest swaps a mock Runtime, st.secrets and the pages directory flag in and out around every run, so
+    # sessions on other threads would lose them mid-run. Set them once for the whole process like a real server,
+    # and point AppTest's resets at subclasses where they no longer reach the values the script runs read.
+    # It also compiles the script afresh on every run, which races in CPython 3.11's compiler, so share one
+    # ScriptCache the way the server's Runtime does
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage('/mock/media'))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    runtime.bidi_component_registry = BidiComponentManager()
+    runtime.bidi_component_registry.discover_and_register_components(start_file_watching=False)
+    Runtime._instance = runtime
+    app_test.Runtime = SessionRuntime
+    PagesManager.uses_pages_directory = (APP_PATH.parent / 'pages').is_dir()
+    app_test.PagesManager = SessionPagesManager
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    config.set_option('global.appTest', True)
+    st.secrets = Secrets()
+    st.secrets._secrets = secrets
+
+
+def check(app):
+    # st.error is how final.py reports failed analyses, treat it like an uncaught exception
+    problems = [exception.message for exception in app.exception] + [error.value for error in app.error]
+    if problems:
+        raise RuntimeError('; '.join(problems))
+
+
+def rerun(app, edits):
+    # AppTest has no data_editor element, so send the edit payload the browser would for each editor on the page.
+    # The browser resends it on every rerun until the editor goes away, so this does too
+    states = app._tree.get_widget_states()
+    for editor in app.dataframe:
+        if editor.key in edits:
+            state = states.widgets.add()
+            state.id = editor.proto.id
+            state.string_value = json.dumps(edits[editor.key])
+    return app._run(states)
+
+
+def reviewer_edits(app):
+    edits = {'fields_editor': {'edited_rows': {'0': {'Value': 'Edited during load test'}},
+                               'added_rows': [], 'deleted_rows': []}}
+    if any(editor.key == 'items_editor' for editor in app.dataframe):
+        edits['items_editor'] = {'edited_rows': {'0': {'Description': 'Edited item'}},
+                                 'added_rows': [], 'deleted_rows': []}
+    return edits
+
+
+def run_session(samples, args, timings, captions, lock):
+    # One simulated reviewer in their own browser session, uploading, editing and exporting invoices one after another
+    session_timings = {stage: [] for stage in STAGES}
+
+    def timed(stage, function, *function_args):
+        started = time.perf_counter()
+        result = function(*function_args)
+        session_timings[stage].append(time.perf_counter() - started)
+        check(result)
+        return result
+
+    app = AppTest.from_file(str(APP_PATH), default_timeout=args.timeout)
+    try:
+        timed('open', app.run)
+        for number, sample in enumerate(samples, start=1):
+            started = time.perf_counter()
+            app.file_uploader[0].set_value((f"loadtest_{number}.pdf", sample, 'application/pdf'))
+            timed('extract', app.run)
+            if app.caption:
+                # Rendered from the cache_resource counter every session shares
+                with lock:
+                    captions.append(app.caption[0].value)
+
+            time.sleep(args.think_time)
+            edits = reviewer_edits(app)
+            timed('edit', rerun, app, edits)
+            next(button for button in app.button if button.label == 'Finalize Edits').click()
+            timed('finalize', rerun, app, edits)
+            if not app.get('download_button'):
+                raise RuntimeError("Finalize Edits did not offer the Excel download")
+
+            app.file_uploader[0].set_value(None)
+            timed('clear', app.run)
+            session_timings['upload'].append(time.perf_counter() - started)
+    finally:
+        with lock:
+            for stage, seconds in session_timings.items():
+                timings[stage].extend(seconds)
+
+
+def percentile(values, percent):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def report(timings, failures, elapsed, service, captions, rss_before):
+    completed = len(timings['upload'])
+    print(f"\nCompleted {completed} uploads in {elapsed:.1f}s, {failures} sessions failed")
+    print(f"Throughput: {completed / elapsed:.2f} invoices/s ({completed / elapsed * 3600:.0f}/h)")
+    print(f"\n{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in STAGES:
+        values = timings[stage]
+        if not values:
+            continue
+        print(f"{stage:<12}{len(values):>7}" + ''.join(
+            f"{value * 1000:>10.0f}" for value in
+            (percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values))))
+
+    # ru_maxrss is reported in kilobytes on Linux
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"\nPeak RSS: {rss_after / 1024:.0f} MB (+{(rss_after - rss_before) / 1024:.0f} MB during the run)")
+    if captions:
+        print(f"Last routing caption: {captions[-1]}")
+    if service is not None:
+        print(f"Mock service: {service.counts['analyze']} analyze calls, {service.counts['poll']} polls, "
+              f"{service.counts['throttled']} throttled")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive simulated reviewer sessions of final.py against a mock Document Intelligence service")
+    parser.add_argument('--sessions', type=int, default=50, help="Concurrent simulated reviewers")
+    parser.add_argument('--uploads', type=int, default=4, help="Invoices each reviewer processes, one after another")
+    parser.add_argument('--pages', type=int, default=2, help="Pages in the generated sample PDF")
+    parser.add_argument('--sample', help="Use this invoice file for every upload instead of generated PDFs")
+    parser.add_argument('--repeat-rate', type=float, default=0.5,
+                        help="Share of generated uploads that resend an invoice already analyzed")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Seconds a reviewer spends editing")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Seconds one script run may take")
+    parser.add_argument('--custom-model-id', default='custom-invoice')
+    parser.add_argument('--confidence-threshold', type=float, default=0.8)
+    parser.add_argument('--endpoint', help="Use an already running mock service instead of starting one")
+    parser.add_argument('--latency', type=float, default=1.0)
+    parser.add_argument('--jitter', type=float, default=0.25)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--payload-dir')
+    parser.add_argument('--line-items', type=int, default=10)
+    parser.add_argument('--confidence', type=float, default=0.9, help="Field confidence the mock reports")
+    args = parser.parse_args()
+
+    index_dir = tempfile.TemporaryDirectory()
+    # Read by invoice_index when final.py first imports it, so extractions and cached analyses stay in the throwaway index
+    os.environ['INVOICE_INDEX_PATH'] = os.path.join(index_dir.name, 'loadtest_index.db')
+
+    service = None
+    server = None
+    endpoint = args.endpoint
+    try:
+        if endpoint is None:
+            service = MockService(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+                                  retry_after=args.retry_after, payload_dir=args.payload_dir,
+                                  line_items=args.line_items, confidence=args.confidence)
+            server, endpoint = start_server(service)
+        share_app_test_globals({
+            'azure_document_api_key': 'loadtest',
+            'azure_document_endpoint': endpoint,
+            'custom_model_id': args.custom_model_id,
+            'custom_model_confidence_threshold': args.confidence_threshold,
+        })
+        # Deprecation notices are logged on every script run and would bury the report. Set after the config
+        # change above, which reapplies the configured log level
+        set_log_level('error')
+
+        sample = Path(args.sample).read_bytes() if args.sample else sample_pdf(args.pages)
+        session_samples = [
+            [sample if args.sample or random.random() < args.repeat_rate
+             else sample_pdf(args.pages, session * args.uploads + upload) for upload in range(args.uploads)]
+            for session in range(args.sessions)]
+
+        timings = {stage: [] for stage in STAGES}
+        captions = []
+        lock = threading.Lock()
+        failures = 0
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        print(f"Running {args.sessions} sessions x {args.uploads} uploads of {APP_PATH.name} against {endpoint}")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            futures = [executor.submit(run_session, samples, args, timings, captions, lock)
+                       for samples in session_samples]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"Session failed: {type(e).__name__}: {e}")
+        elapsed = time.perf_counter() - started
+
+        report(timings, failures, elapsed, service, captions, rss_before)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        index_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from pypdf import PdfReader
+
+
+# Stand-in for the Document Intelligence analyze/poll protocol used by both SDKs:
+#   POST /{formrecognizer|documentintelligence}/documentModels/{model_id}:analyze  -> 202 + Operation-Location
+#   GET  /{formrecognizer|documentintelligence}/documentModels/{model_id}/analyzeResults/{result_id}
+ANALYZE_PATH = re.compile(r'^/(formrecognizer|documentintelligence)/documentModels/([^/:]+):analyze$')
+RESULT_PATH = re.compile(r'^/(formrecognizer|documentintelligence)/documentModels/([^/]+)/analyzeResults/([^/]+)$')
+
+VENDORS = ['Contoso Ltd', 'Fabrikam Inc', 'Northwind Traders', 'Tailspin Toys', 'Wide World Importers']
+
+
+def region(page_number=1):
+    return [{'pageNumber': page_number, 'polygon': [1.0, 1.0, 2.0, 1.0, 2.0, 1.5, 1.0, 1.5]}]
+
+
+def string_field(text, confidence=0.95, page_number=1):
+    return {'type': 'string', 'valueString': text, 'content': text, 'confidence': confidence,
+            'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': len(text)}]}
+
+
+def currency_field(amount, confidence=0.95, page_number=1):
+    text = f"${amount:,.2f}"
+    return {'type': 'currency', 'valueCurrency': {'amount': amount, 'currencySymbol': '$', 'currencyCode': 'USD'},
+            'content': text, 'confidence': confidence, 'boundingRegions': region(page_number),
+            'spans': [{'offset': 0, 'length': len(text)}]}
+
+
+def number_field(number, page_number=1):
+    return {'type': 'number', 'valueNumber': number, 'content': str(number), 'confidence': 0.95,
+            'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': len(str(number))}]}
+
+
+def requested_pages(body, pages):
+    # Results report real page numbers, so a pages=2,5 request gets pages 2 and 5 back
+    if pages:
+        numbers = []
+        for part in pages.split(','):
+            first, _, last = part.partition('-')
+            numbers.extend(range(int(first), int(last or first) + 1))
+        return numbers
+    try:
+        return list(range(1, len(PdfReader(BytesIO(body)).pages) + 1))
+    except Exception:
+        return [1]
+
+
+def base_result(model_id, page_numbers):
+    return {
+        'apiVersion': '2023-07-31',
+        'modelId': model_id,
+        'stringIndexType': 'textElements',
+        'content': '',
+        'pages': [{'pageNumber': number, 'angle': 0, 'width': 8.5, 'height': 11, 'unit': 'inch',
+                   'words': [], 'lines': [], 'spans': [{'offset': 0, 'length': 0}]}
+                  for number in page_numbers],
+        'tables': [],
+        'documents': [],
+    }
+
+
+def invoice_result(model_id, page_numbers, line_items, confidence):
+    result = base_result(model_id, page_numbers)
+    items = []
+    subtotal = 0.0
+    for index in range(line_items):
+        quantity = random.randint(1, 20)
+        unit_price = round(random.uniform(1, 500), 2)
+        amount = round(quantity * unit_price, 2)
+        subtotal += amount
+        page_number = page_numbers[index * len(page_numbers) // max(line_items, 1)]
+        items.append({'type': 'object', 'content': f"Item {index + 1}", 'confidence': confidence,
+                      'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': 0}],
+                      'valueObject': {
+                          'Description': string_field(f"Item {index + 1}", confidence, page_number),
+                          'Quantity': number_field(quantity, page_number),
+                          'UnitPrice': currency_field(unit_price, confidence, page_number),
+                          'Amount': currency_field(amount, confidence, page_number),
+                      }})
+    tax = round(subtotal * 0.08, 2)
+    invoice_date = f"2024-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+    result['documents'].append({
+        'docType': 'invoice',
+        'confidence': confidence,
+        'boundingRegions': region(),
+        'spans': [{'offset': 0, 'length': 0}],
+        'fields': {
+            'VendorName': string_field(random.choice(VENDORS), confidence, page_numbers[0]),
+            'InvoiceId': string_field(f"INV-{random.randint(10000, 99999)}", confidence, page_numbers[0]),
+            'InvoiceDate': {'type': 'date', 'valueDate': invoice_date, 'content': invoice_date,
+                            'confidence': confidence, 'boundingRegions': region(page_numbers[0]),
+                            'spans': [{'offset': 0, 'length': 10}]},
+            'SubTotal': currency_field(round(subtotal, 2), confidence, page_numbers[-1]),
+            'TotalTax': currency_field(tax, confidence, page_numbers[-1]),
+            'InvoiceTotal': currency_field(round(subtotal + tax, 2), confidence, page_numbers[-1]),
+            'Items': {'type': 'array', 'valueArray': items},
+        },
+    })
+    return result
+
+
+def layout_result(model_id, page_numbers, line_items):
+    result = base_result(model_id, page_numbers)
+    # One table per page, like a line-item table that continues across pages
+    for page_number in page_numbers:
+        cells = [{'kind': 'columnHeader', 'rowIndex': 0, 'columnIndex': column, 'content': header,
+                  'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': 0}]}
+                 for column, header in enumerate(['Description', 'Qty', 'Amount'])]
+        for row in range(1, line_items + 1):
+            for column, content in enumerate([f"Item {row}", str(random.randint(1, 20)),
+                                              f"{random.uniform(1, 5000):.2f}"]):
+                cells.append({'rowIndex': row, 'columnIndex': column, 'content': content,
+                              'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': 0}]})
+        result['tables'].append({'rowCount': line_items + 1, 'columnCount': 3, 'cells': cells,
+                                 'boundingRegions': region(page_number), 'spans': [{'offset': 0, 'length': 0}]})
+    return result
+
+
+def custom_result(model_id, page_numbers, confidence):
+    result = base_result(model_id, page_numbers)
+    result['documents'].append({
+        'docType': f"{model_id}:{model_id}",
+        'confidence': confidence,
+        'boundingRegions': region(),
+        'spans': [{'offset': 0, 'length': 0}],
+        'fields': {
+            'PurchaseOrder': string_field(f"PO-{random.randint(1000, 9999)}", confidence),
+            'PaymentTerms': string_field('Net 30', confidence),
+        },
+    })
+    return result
+
+
+class MockService:
+    def __init__(self, latency=1.0, jitter=0.25, throttle_rate=0.0, retry_after=1, payload_dir=None,
+                 line_items=10, confidence=0.9):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.line_items = line_items
+        self.confidence = confidence
+        # Recorded analyzeResult payloads, one {model_id}.json per model, replace the generated ones
+        self.recorded = {}
+        if payload_dir:
+            for path in Path(payload_dir).glob('*.json'):
+                payload = json.loads(path.read_text())
+                self.recorded[path.stem] = payload.get('analyzeResult', payload)
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.counts = {'analyze': 0, 'poll': 0, 'throttled': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def build_result(self, model_id, page_numbers):
+        if model_id in self.recorded:
+            return self.recorded[model_id]
+        if model_id == 'prebuilt-invoice':
+            return invoice_result(model_id, page_numbers, self.line_items, self.confidence)
+        if model_id == 'prebuilt-layout':
+            return layout_result(model_id, page_numbers, self.line_items)
+        return custom_result(model_id, page_numbers, self.confidence)
+
+    def start_operation(self, model_id, page_numbers):
+        result_id = uuid.uuid4().hex
+        delay = max(0.0, random.gauss(self.latency, self.jitter))
+        with self.lock:
+            self.operations[result_id] = {
+                'ready_at': time.monotonic() + delay,
+                'created': datetime.now(timezone.utc).isoformat(),
+                'result': self.build_result(model_id, page_numbers),
+            }
+        return result_id
+
+    def operation_status(self, result_id):
+        with self.lock:
+            operation = self.operations.get(result_id)
+            if operation is None:
+                return None
+            if time.monotonic() < operation['ready_at']:
+                return {'status': 'running', 'createdDateTime': operation['created'],
+                        'lastUpdatedDateTime': operation['created']}
+            # Finished operations are served once, the SDK does not poll again after success
+            del self.operations[result_id]
+        now = datetime.now(timezone.utc).isoformat()
+        return {'status': 'succeeded', 'createdDateTime': operation['created'], 'lastUpdatedDateTime': now,
+                'analyzeResult': operation['result']}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body=None, headers=None):
+            payload = json.dumps(body).encode() if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def throttled(self):
+            if random.random() < service.throttle_rate:
+                service.count('throttled')
+                self.send_json(429, {'error': {'code': '429', 'message': 'Rate limit exceeded.'}},
+                               {'Retry-After': str(service.retry_after)})
+                return True
+            return False
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            match = ANALYZE_PATH.match(url.path)
+            if match is None:
+                self.send_json(404, {'error': {'code': 'NotFound', 'message': url.path}})
+                return
+            if self.throttled():
+                return
+            service.count('analyze')
+            prefix, model_id = match.groups()
+            query = parse_qs(url.query)
+            page_numbers = requested_pages(body, query.get('pages', [None])[0])
+            result_id = service.start_operation(model_id, page_numbers)
+            api_version = query.get('api-version', [''])[0]
+            host = self.headers.get('Host')
+            location = (f"http://{host}/{prefix}/documentModels/{model_id}/analyzeResults/{result_id}"
+                        f"?api-version={api_version}")
+            self.send_json(202, None, {'Operation-Location': location, 'Retry-After': str(service.retry_after)})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            match = RESULT_PATH.match(url.path)
+            if match is None:
+                self.send_json(404, {'error': {'code': 'NotFound', 'message': url.path}})
+                return
+            if self.throttled():
+                return
+            service.count('poll')
+            status = service.operation_status(match.group(3))
+            if status is None:
+                self.send_json(404, {'error': {'code': 'NotFound', 'message': 'Unknown analyze operation.'}})
+                return
+            self.send_json(200, status, {'Retry-After': str(service.retry_after)})
+
+    return Handler
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections once a few dozen sessions start polling at once
+    request_queue_size = 256
+
+
+def start_server(service, host='127.0.0.1', port=0):
+    server = MockServer((host, port), make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Document Intelligence service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=1.0, help="Seconds before an analysis succeeds")
+    parser.add_argument('--jitter', type=float, default=0.25)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--payload-dir', help="Directory of recorded {model_id}.json analyze results")
+    parser.add_argument('--line-items', type=int, default=10)
+    args = parser.parse_args()
+
+    mock = MockService(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+                       retry_after=args.retry_after, payload_dir=args.payload_dir, line_items=args.line_items)
+    server = MockServer((args.host, args.port), make_handler(mock))
+    print(f"Mock Document Intelligence listening on http://{args.host}:{args.port}/")
+    server.serve_forever()
@@ -0,0 +1,89 @@
+import os
+import streamlit as st
+from batch_analytics import create_summary_excel, new_cache, refresh_cache
+from excel_export import write_batch_workbook
+from invoice_index import invoice_ids, iter_extractions
+
+
+st.set_page_config(layout="wide")
+
+# Streamlit holds download data in memory, so the page builds workbooks of at most this many invoices.
+# Bigger batches go through the API's /export.xlsx, which streams the workbook from disk
+EXPORT_CHUNK_SIZE = int(os.environ.get('BATCH_EXPORT_CHUNK_SIZE', 200))
+
+
+@st.cache_resource
+def analytics_cache():
+    # One cache per server, every refresh only summarizes invoices saved since the last one
+    return new_cache()
+
+
+st.title("Batch Analytics")
+
+aggregates = refresh_cache(analytics_cache())
+by_vendor = aggregates['by_vendor']
+by_period = aggregates['by_period']
+by_vendor_period = aggregates['by_vendor_period']
+
+if by_vendor_period.empty:
+    st.info("No extracted invoices yet. Invoices show up here once they have been processed.")
+    st.stop()
+
+currencies = sorted(by_vendor['currency'].unique())
+currency = st.selectbox("Currency", currencies)
+
+vendor_view = by_vendor[by_vendor['currency'] == currency]
+period_view = by_period[by_period['currency'] == currency]
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Invoices", int(vendor_view['invoices'].sum()))
+col2.metric("Total spend", f"{vendor_view['total'].sum():,.2f}")
+col3.metric("Total tax", f"{vendor_view['tax'].sum():,.2f}")
+col4.metric("Line item quantity", f"{vendor_view['quantity'].sum():,.0f}")
+
+st.write("Spend by vendor:")
+st.bar_chart(vendor_view.set_index('vendor')['total'])
+st.write("Spend by month:")
+st.bar_chart(period_view.set_index('period')[['total', 'tax']])
+
+st.write("Vendor and period totals:")
+st.dataframe(by_vendor_period[by_vendor_period['currency'] == currency], use_container_width=True, hide_index=True)
+
+st.download_button(
+    label="Download summary sheet",
+    data=create_summary_excel(aggregates),
+    file_name="invoice_batch_summary.xlsx",
+    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+)
+
+invoice_pks = invoice_ids()
+chunks = [invoice_pks[start:start + EXPORT_CHUNK_SIZE] for start in range(0, len(invoice_pks), EXPORT_CHUNK_SIZE)]
+
+st.write("Workbook with one sheet per invoice:")
+chunk = st.selectbox(
+    "Invoices", range(len(chunks)),
+    format_func=lambda number: f"{number * EXPORT_CHUNK_SIZE + 1}-{number * EXPORT_CHUNK_SIZE + len(chunks[number])} "
+                               f"of {len(invoice_pks)}")
+if len(chunks) > 1:
+    st.caption(f"Workbooks are split every {EXPORT_CHUNK_SIZE} invoices. "
+               "Use the API's /export.xlsx to export the whole batch in one file.")
+chunk_range = (chunks[chunk][0], chunks[chunk][-1])
+
+if st.button("Build workbook"):
+    with st.spinner("Writing one sheet per invoice..."):
+        # Invoices are streamed from the index into the workbook, only one is in memory at a time
+        workbook_path = write_batch_workbook(iter_extractions(chunks[chunk]))
+    try:
+        with open(workbook_path, 'rb') as workbook_file:
+            st.session_state.batch_workbook = (chunk_range, workbook_file.read())
+    finally:
+        os.remove(workbook_path)
+
+# Kept in session state so the button survives the rerun a click on it triggers
+if st.session_state.get('batch_workbook', (None,))[0] == chunk_range:
+    st.download_button(
+        label="Download invoice workbook",
+        data=st.session_state.batch_workbook[1],
+        file_name=f"invoice_batch_{chunk_range[0]}-{chunk_range[1]}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
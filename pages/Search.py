@@ -0,0 +1,35 @@
+import streamlit as st
+from invoice_index import load_extraction, search_invoices
+
+
+st.set_page_config(layout="wide")
+
+st.title("Search Extracted Invoices")
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    vendor = st.text_input("Vendor name starts with")
+    text = st.text_input("Any field or line item contains")
+with col2:
+    min_total = st.number_input("Minimum total", min_value=0.0, value=None)
+    max_total = st.number_input("Maximum total", min_value=0.0, value=None)
+with col3:
+    date_from = st.date_input("Invoice date from", value=None)
+    date_to = st.date_input("Invoice date to", value=None)
+
+results = search_invoices(vendor=vendor, min_total=min_total, max_total=max_total,
+                          date_from=date_from, date_to=date_to, text=text)
+
+st.write(f"{len(results)} matching invoices")
+st.dataframe(results, use_container_width=True, hide_index=True)
+
+if not results.empty:
+    invoice_pk = st.selectbox("Show stored extraction", results['id'],
+                              format_func=lambda pk: results.loc[results['id'] == pk, 'filename'].iloc[0])
+    stored = load_extraction(int(invoice_pk))
+    if stored:
+        fields_df, items_df, table_df = stored
+        for label, df in (("Field Data", fields_df), ("Line Items", items_df), ("Table data", table_df)):
+            if not df.empty:
+                st.write(f"{label}:")
+                st.dataframe(df, use_container_width=True)
@@ -0,0 +1,103 @@
+from io import BytesIO
+
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+
+
+# Document Intelligence input limits (S0 tier)
+MAX_FILE_SIZE_MB = 500
+MAX_PDF_PAGES = 2000
+MIN_IMAGE_SIDE = 50
+MAX_IMAGE_SIDE = 10000
+
+MAGIC_BYTES = [
+    (b'%PDF-', 'application/pdf'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+]
+
+PIL_FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG'}
+
+
+class PreflightError(ValueError):
+    pass
+
+
+def sniff_content_type(file_bytes):
+    for magic, content_type in MAGIC_BYTES:
+        if file_bytes.startswith(magic):
+            return content_type
+    # Some PDF writers put junk before the header, the spec allows it within the first 1024 bytes.
+    # Only checked once the image signatures at offset 0 have not matched, a JPEG can carry %PDF- in its EXIF
+    if b'%PDF-' in file_bytes[:1024]:
+        return 'application/pdf'
+    return None
+
+
+def check_pdf(file_bytes, max_pages=MAX_PDF_PAGES):
+    try:
+        reader = PdfReader(BytesIO(file_bytes))
+        if reader.is_encrypted:
+            # Owner-password-only PDFs open with an empty user password, so they can be rewritten unlocked
+            if not reader.decrypt(''):
+                raise PreflightError("PDF is password protected.")
+            writer = PdfWriter(clone_from=reader)
+            output = BytesIO()
+            writer.write(output)
+            file_bytes = output.getvalue()
+        page_count = len(reader.pages)
+        if page_count == 0:
+            raise PreflightError("PDF has no pages.")
+        if page_count > max_pages:
+            raise PreflightError(f"PDF has {page_count} pages, the limit is {max_pages}.")
+        # Parse every page here, a file that passes preflight must not fail later while being hashed
+        for page in reader.pages:
+            page.mediabox
+            page.get_contents()
+    except PreflightError:
+        raise
+    except Exception as e:
+        # Malformed files raise plain ValueError and AttributeError as well as pypdf's own errors
+        raise PreflightError(f"PDF could not be read: {e}")
+    return file_bytes
+
+
+def check_image(file_bytes, content_type):
+    try:
+        image = Image.open(BytesIO(file_bytes))
+        image.verify()
+        # verify() leaves the image unusable, so reopen it for the size check and any resize
+        image = Image.open(BytesIO(file_bytes))
+    except Exception as e:
+        raise PreflightError(f"Image could not be read: {e}")
+
+    width, height = image.size
+    if min(width, height) < MIN_IMAGE_SIDE:
+        raise PreflightError(f"Image is {width}x{height}, both sides must be at least {MIN_IMAGE_SIDE} pixels.")
+    if max(width, height) > MAX_IMAGE_SIDE:
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        output = BytesIO()
+        image.save(output, format=PIL_FORMATS[content_type])
+        file_bytes = output.getvalue()
+    return file_bytes
+
+
+def preflight_file(file_bytes, filename, max_file_size_mb=MAX_FILE_SIZE_MB, max_pages=MAX_PDF_PAGES):
+    if not file_bytes:
+        raise PreflightError(f"{filename} is empty.")
+    if len(file_bytes) > max_file_size_mb * 1024 * 1024:
+        raise PreflightError(f"{filename} is larger than {max_file_size_mb} MB.")
+
+    # Trust the file contents over the extension, mislabeled uploads are fixed up here
+    content_type = sniff_content_type(file_bytes)
+    if content_type is None:
+        raise PreflightError(f"{filename} is not a PDF, JPG or PNG file.")
+
+    if content_type == 'application/pdf':
+        file_bytes = check_pdf(file_bytes, max_pages=max_pages)
+    else:
+        file_bytes = check_image(file_bytes, content_type)
+
+    if len(file_bytes) > max_file_size_mb * 1024 * 1024:
+        raise PreflightError(f"{filename} is larger than {max_file_size_mb} MB.")
+    return file_bytes, content_type
@@ -0,0 +1,169 @@
+from io import BytesIO
+
+import pytest
+from azure.ai.documentintelligence.models import AnalyzeResult
+from pypdf import PdfWriter
+from pypdf.generic import (ArrayObject, BooleanObject, DecodedStreamObject, DictionaryObject, FloatObject,
+                           NameObject, TextStringObject)
+
+from incremental import analyze_with_reuse, changed_pages, page_hashes
+from invoice_index import find_analysis, save_analysis
+
+
+def invoice_pdf(page_texts, total=None):
+    # One page per entry, each page's text goes into its content stream
+    writer = PdfWriter()
+    for text in page_texts:
+        page = writer.add_blank_page(width=612, height=792)
+        contents = DecodedStreamObject()
+        contents.set_data(f"BT ({text}) Tj ET".encode())
+        page.replace_contents(contents)
+    if total is not None:
+        # A NeedAppearances text field on the first page whose value only lives in /V of its parent field
+        field = DictionaryObject({
+            NameObject('/FT'): NameObject('/Tx'),
+            NameObject('/T'): TextStringObject('Total'),
+            NameObject('/V'): TextStringObject(total),
+        })
+        field_ref = writer._add_object(field)
+        widget_ref = writer._add_object(DictionaryObject({
+            NameObject('/Type'): NameObject('/Annot'),
+            NameObject('/Subtype'): NameObject('/Widget'),
+            NameObject('/Rect'): ArrayObject([FloatObject(value) for value in (400, 100, 500, 120)]),
+            NameObject('/Parent'): field_ref,
+        }))
+        field[NameObject('/Kids')] = ArrayObject([widget_ref])
+        writer.pages[0][NameObject('/Annots')] = ArrayObject([widget_ref])
+        writer._root_object[NameObject('/AcroForm')] = DictionaryObject({
+            NameObject('/Fields'): ArrayObject([field_ref]),
+            NameObject('/NeedAppearances'): BooleanObject(True),
+        })
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def region(page_number):
+    return [{'pageNumber': page_number, 'polygon': [0, 0, 1, 0, 1, 1, 0, 1]}]
+
+
+class FakeService:
+    """Answers like prebuilt-invoice with one line item and one table per page, recording the pages asked for."""
+
+    def __init__(self, page_texts):
+        self.page_texts = page_texts
+        self.calls = []
+
+    def analyze(self, pages):
+        self.calls.append(pages)
+        numbers = range(1, len(self.page_texts) + 1)
+        if pages is not None:
+            numbers = [int(number) for number in pages.split(',')]
+        return AnalyzeResult({
+            'apiVersion': '2024-11-30',
+            'modelId': 'prebuilt-invoice',
+            'content': '',
+            'pages': [{'pageNumber': number, 'spans': [],
+                       'words': [{'content': self.page_texts[number - 1], 'confidence': 1.0,
+                                  'span': {'offset': 0, 'length': 1}}]} for number in numbers],
+            'tables': [{'rowCount': 1, 'columnCount': 1, 'boundingRegions': region(number),
+                        'cells': [{'rowIndex': 0, 'columnIndex': 0, 'content': self.page_texts[number - 1]}]}
+                       for number in numbers],
+            'documents': [{
+                'docType': 'invoice', 'confidence': 1.0, 'spans': [],
+                'fields': {
+                    **({'VendorName': {'type': 'string', 'valueString': self.page_texts[0],
+                                       'content': self.page_texts[0], 'confidence': 0.9,
+                                       'boundingRegions': region(1)}} if 1 in numbers else {}),
+                    'Items': {'type': 'array', 'valueArray': [
+                        {'type': 'object', 'content': self.page_texts[number - 1], 'boundingRegions': region(number),
+                         'valueObject': {'Description': {'type': 'string', 'content': self.page_texts[number - 1]}}}
+                        for number in numbers]},
+                },
+            }],
+        })
+
+
+def analyze(service, file_bytes, db_path):
+    return analyze_with_reuse('prebuilt-invoice', page_hashes(file_bytes, 'application/pdf'), service.analyze,
+                              db_path=db_path)
+
+
+def item_descriptions(result):
+    return [item.value_object['Description'].content for item in result.documents[0].fields['Items'].value_array]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'index.db')
+
+
+def test_page_hashes_change_only_for_the_edited_page():
+    old = page_hashes(invoice_pdf(['one', 'two', 'three']), 'application/pdf')
+    new = page_hashes(invoice_pdf(['one', 'TWO', 'three']), 'application/pdf')
+    assert len(old) == 3
+    assert [old[0], old[2]] == [new[0], new[2]]
+    assert old[1] != new[1]
+    assert changed_pages(old, new) == [2]
+
+
+def test_removed_pages_count_as_changed():
+    old = page_hashes(invoice_pdf(['one', 'two', 'three']), 'application/pdf')
+    new = page_hashes(invoice_pdf(['one', 'two']), 'application/pdf')
+    assert changed_pages(old, new) == [3]
+
+
+def test_form_field_value_changes_the_page_hash():
+    old = page_hashes(invoice_pdf(['one', 'two'], total='100.00'), 'application/pdf')
+    new = page_hashes(invoice_pdf(['one', 'two'], total='999.00'), 'application/pdf')
+    assert old[0] != new[0]
+    assert old[1] == new[1]
+
+
+def test_unreadable_pdf_falls_back_to_a_whole_file_hash():
+    file_bytes = invoice_pdf(['one', 'two']).replace(b'/MediaBox [ 0.0 0.0 612 792 ]', b'/MediaBox [ 0.0 0.0 x 792 ]')
+    assert len(page_hashes(file_bytes, 'application/pdf')) == 1
+
+
+def test_identical_upload_reuses_the_stored_result(db_path):
+    file_bytes = invoice_pdf(['one', 'two', 'three'])
+    service = FakeService(['one', 'two', 'three'])
+    analyze(service, file_bytes, db_path)
+    result = analyze(service, file_bytes, db_path)
+    assert service.calls == [None]
+    assert item_descriptions(result) == ['one', 'two', 'three']
+
+
+def test_changed_page_is_reanalyzed_and_spliced(db_path):
+    analyze(FakeService(['one', 'two', 'three']), invoice_pdf(['one', 'two', 'three']), db_path)
+    service = FakeService(['one', 'TWO', 'three'])
+    result = analyze(service, invoice_pdf(['one', 'TWO', 'three']), db_path)
+    assert service.calls == ['2']
+    assert item_descriptions(result) == ['one', 'TWO', 'three']
+    assert [table.cells[0].content for table in result.tables] == ['one', 'TWO', 'three']
+    assert result.documents[0].fields['VendorName'].content == 'one'
+
+
+def test_removed_page_is_dropped_without_a_service_call(db_path):
+    analyze(FakeService(['one', 'two', 'three']), invoice_pdf(['one', 'two', 'three']), db_path)
+    service = FakeService(['one', 'two'])
+    result = analyze(service, invoice_pdf(['one', 'two']), db_path)
+    assert service.calls == []
+    assert [page.page_number for page in result.pages] == [1, 2]
+    assert item_descriptions(result) == ['one', 'two']
+
+
+def test_form_edit_reanalyzes_the_form_page(db_path):
+    analyze(FakeService(['one', 'two', 'three']), invoice_pdf(['one', 'two', 'three'], total='100.00'), db_path)
+    service = FakeService(['one', 'two', 'three'])
+    analyze(service, invoice_pdf(['one', 'two', 'three'], total='999.00'), db_path)
+    assert service.calls == ['1']
+
+
+def test_only_the_newest_analyses_are_kept(db_path):
+    for text in ['one', 'two', 'three']:
+        save_analysis('prebuilt-invoice', [text], 'documentintelligence', '{}', keep=2, db_path=db_path)
+    save_analysis('prebuilt-layout', ['one'], 'documentintelligence', '{}', keep=2, db_path=db_path)
+    assert find_analysis('prebuilt-invoice', ['one'], db_path=db_path) is None
+    assert find_analysis('prebuilt-invoice', ['two'], db_path=db_path) is not None
+    assert find_analysis('prebuilt-layout', ['one'], db_path=db_path) is not None